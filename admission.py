@@ -0,0 +1,155 @@
+import math
+import threading
+import time
+from collections import defaultdict
+
+from werkzeug.wsgi import ClosingIterator
+
+# Served to shed requests without touching Flask, sessions or templates
+OVERLOADED_PAGE = (
+    b'<!doctype html><html lang=en><title>Busy</title>'
+    b'<p>The server is busy right now. Please try again in a moment.</p></html>'
+)
+
+
+def queue_delay(environ, header, now=None):
+    # Seconds since the proxy stamped the request, from e.g. "X-Request-Start: t=1700000000.123"
+    # (nginx) or a bare number of seconds, milliseconds (Heroku) or microseconds
+    value = environ.get('HTTP_' + header.upper().replace('-', '_'))
+    if not value:
+        return None
+    try:
+        started = float(value.strip().removeprefix('t='))
+    except ValueError:
+        return None
+    while started > 1e11:  # Milliseconds or microseconds since the epoch
+        started /= 1000
+    return max(0.0, (now or time.time()) - started)
+
+
+def client_id(environ):
+    # The address the nearest proxy saw; earlier X-Forwarded-For entries are client-supplied
+    forwarded = environ.get('HTTP_X_FORWARDED_FOR')
+    if forwarded:
+        return forwarded.split(',')[-1].strip()
+    return environ.get('REMOTE_ADDR', '')
+
+
+class AdmissionController:
+    # Adaptive concurrency limit for this worker process. Queueing delay is judged the CoDel
+    # way: if even the shortest delay seen during an interval is above target_delay, there is
+    # a standing queue; the limit is then multiplied by `backoff`, and requests that queued
+    # longer than target_delay are shed while it lasts. Each interval without a standing
+    # queue raises the limit by one (AIMD). One client may hold at most client_share of the
+    # limit, so a single heavy user cannot starve the rest.
+
+    def __init__(self, target_delay, interval, min_limit, max_limit, backoff=0.9, client_share=0.5):
+        self.target_delay = target_delay
+        self.interval = interval
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.client_share = client_share
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.overloaded = False
+        self._clients = defaultdict(int)
+        self._min_delay = math.inf
+        self._interval_end = time.monotonic() + interval
+        self._lock = threading.Lock()
+
+    def _observe(self, delay):
+        now = time.monotonic()
+        if delay is not None:
+            self._min_delay = min(self._min_delay, delay)
+        if now < self._interval_end:
+            return
+
+        # Intervals without any measured delay leave the limit alone
+        if self._min_delay != math.inf:
+            self.overloaded = self._min_delay > self.target_delay
+            if self.overloaded:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1)
+        self._min_delay = math.inf
+        self._interval_end = now + self.interval
+
+    def client_limit(self):
+        if not self.client_share:
+            return math.inf
+        return max(1, math.floor(self.limit * self.client_share))
+
+    def admit(self, client, delay=None):
+        # Returns None when the request may proceed (call release() when it is done), or
+        # the reason it was shed: 'delay', 'limit' or 'client'
+        with self._lock:
+            self._observe(delay)
+            if self.overloaded and delay is not None and delay > self.target_delay:
+                return 'delay'
+            if self.in_flight >= math.floor(self.limit):
+                return 'limit'
+            if self._clients[client] >= self.client_limit():
+                return 'client'
+            self.in_flight += 1
+            self._clients[client] += 1
+            return None
+
+    def release(self, client):
+        with self._lock:
+            self.in_flight -= 1
+            self._clients[client] -= 1
+            if not self._clients[client]:
+                del self._clients[client]
+
+
+class AdmissionMiddleware:
+    # WSGI middleware in front of the Flask app: requests outside the exempt path prefixes
+    # need an admission, and shed ones get a static 503 page
+
+    def __init__(self, wsgi_app, controller, exempt_paths=(), delay_header='X-Request-Start', retry_after=1,
+                 on_reject=None):
+        self.wsgi_app = wsgi_app
+        self.controller = controller
+        self.exempt_paths = tuple(exempt_paths)
+        self.delay_header = delay_header
+        self.retry_after = retry_after
+        self.on_reject = on_reject
+
+    def exempt(self, environ):
+        return environ.get('PATH_INFO', '').startswith(self.exempt_paths)
+
+    def admit(self, environ):
+        # Returns the client to release once the response is finished, or a reason to shed
+        client = client_id(environ)
+        reason = self.controller.admit(client, queue_delay(environ, self.delay_header))
+        if reason is not None and self.on_reject is not None:
+            self.on_reject(reason)
+        return client, reason
+
+    def rejection(self):
+        # Status, headers and body of the static 503 response
+        return '503 Service Unavailable', [
+            ('Content-Type', 'text/html; charset=utf-8'),
+            ('Content-Length', str(len(OVERLOADED_PAGE))),
+            ('Retry-After', str(self.retry_after)),
+            ('Cache-Control', 'no-store'),
+        ], OVERLOADED_PAGE
+
+    def __call__(self, environ, start_response):
+        if self.exempt(environ):
+            return self.wsgi_app(environ, start_response)
+
+        client, reason = self.admit(environ)
+        if reason is not None:
+            status, headers, body = self.rejection()
+            start_response(status, headers)
+            return [body]
+
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.controller.release(client)
+            raise
+        # Streamed bodies keep their admission until the server closes them
+        return ClosingIterator(response, lambda: self.controller.release(client))
@@ -0,0 +1,145 @@
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+# Politeness tacked onto the end of a question does not change the answer
+trailing_filler = re.compile(r'(?:\s+(?:please|pls|plz|thanks|thank you|thx|for me|if you can|if possible))+$')
+
+
+def normalize_question(question):
+    question = re.sub(r'[^\w\s]', ' ', question.lower())
+    question = ' '.join(question.split())
+    return trailing_filler.sub('', ' ' + question).strip() or question
+
+
+class SimilarQuestionIndex:
+    # Hashed character n-gram vectors of answered questions, one matrix per sourceId.
+    # Rows are L2-normalized, so a single matrix-vector product gives every cosine score.
+
+    def __init__(self, threshold, dims=512, ngram=3, max_questions=128, max_sources=500):
+        self.threshold = threshold
+        self.dims = dims
+        self.ngram = ngram
+        self.max_questions = max_questions  # Caps each source at max_questions * dims * 4 bytes
+        self.max_sources = max_sources
+        self._sources = OrderedDict()
+        self._lock = threading.Lock()
+
+    def vectorize(self, question):
+        text = f" {question} "
+        grams = [text[i:i + self.ngram] for i in range(max(len(text) - self.ngram + 1, 1))]
+        buckets = np.fromiter((zlib.crc32(gram.encode()) % self.dims for gram in grams), dtype=np.int64, count=len(grams))
+        vector = np.bincount(buckets, minlength=self.dims).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def add(self, source_id, question):
+        vector = self.vectorize(question)
+        with self._lock:
+            entry = self._sources.get(source_id)
+            if entry is None:
+                entry = {'matrix': np.empty((min(8, self.max_questions), self.dims), dtype=np.float32), 'questions': [], 'next': 0}
+                self._sources[source_id] = entry
+                while len(self._sources) > self.max_sources:
+                    self._sources.popitem(last=False)
+            self._sources.move_to_end(source_id)
+
+            if question in entry['questions']:
+                return
+
+            questions = entry['questions']
+            if len(questions) < self.max_questions:
+                # Grow by doubling until the per-source cap, then overwrite the oldest row
+                if len(questions) == len(entry['matrix']):
+                    grown = np.empty((min(len(questions) * 2, self.max_questions), self.dims), dtype=np.float32)
+                    grown[:len(questions)] = entry['matrix']
+                    entry['matrix'] = grown
+                row = len(questions)
+                questions.append(question)
+            else:
+                row = entry['next']
+                questions[row] = question
+                entry['next'] = (row + 1) % self.max_questions
+            entry['matrix'][row] = vector
+
+    def match(self, source_id, question):
+        vector = self.vectorize(question)
+        with self._lock:
+            entry = self._sources.get(source_id)
+            if entry is None:
+                return None
+            questions = list(entry['questions'])
+            scores = entry['matrix'][:len(questions)] @ vector
+
+        # Character n-grams cannot tell "revenue in 2021" from "revenue in 2022", so numbers must agree
+        numbers = re.findall(r'\d+', question)
+        for row in np.argsort(-scores):
+            if scores[row] < self.threshold:
+                return None
+            if re.findall(r'\d+', questions[row]) == numbers:
+                return questions[row]
+        return None
+
+
+class AnswerCache:
+    # Per-process LRU of answers keyed on (sourceId, normalized question), optionally
+    # falling back to the closest previously answered question for the same source.
+    # on_lookup, if given, is called with 'hit', 'similar_hit' or 'miss' after every get.
+
+    def __init__(self, max_entries, ttl, similar=None, on_lookup=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similar = similar
+        self.on_lookup = on_lookup
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._answers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        entry = self._answers.get(key)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            self._answers.pop(key, None)
+            return None
+        self._answers.move_to_end(key)
+        return entry[0]
+
+    def get(self, source_id, question):
+        answer, result = self._get(source_id, normalize_question(question))
+        if self.on_lookup:
+            self.on_lookup(result)
+        return answer
+
+    def _get(self, source_id, question):
+        with self._lock:
+            answer = self._lookup((source_id, question))
+            if answer is not None:
+                self.hits += 1
+                return answer, 'hit'
+
+        matched = self.similar.match(source_id, question) if self.similar else None
+        with self._lock:
+            answer = self._lookup((source_id, matched)) if matched else None
+            if answer is not None:
+                self.hits += 1
+                self.similar_hits += 1
+                return answer, 'similar_hit'
+            self.misses += 1
+            return None, 'miss'
+
+    def put(self, source_id, question, answer):
+        question = normalize_question(question)
+        with self._lock:
+            self._answers[(source_id, question)] = (answer, time.time())
+            self._answers.move_to_end((source_id, question))
+            while len(self._answers) > self.max_entries:
+                self._answers.popitem(last=False)
+        if self.similar:
+            self.similar.add(source_id, question)
+
+    def size(self):
+        return len(self._answers)
@@ -1,5 +1,6 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from flask import Flask, render_template, request, redirect, url_for, flash
 from dotenv import load_dotenv
@@ -28,6 +29,17 @@ app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # Limit file size (consider
 # Get the API key from the environment variable
 api_key = os.getenv('CHATPDF_API_KEY')
 
+# Configure the upstream ChatPDF client
+base_url = os.getenv('CHATPDF_BASE_URL', 'https://api.chatpdf.com').rstrip('/')
+upstream_timeout = (float(os.getenv('CHATPDF_CONNECT_TIMEOUT', 5)), float(os.getenv('CHATPDF_READ_TIMEOUT', 120)))
+
+# One pooled keep-alive session shared by all upstream calls
+upstream = requests.Session()
+upstream_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv('CHATPDF_POOL_SIZE', 10)), pool_block=True)
+upstream.mount('https://', upstream_adapter)
+upstream.mount('http://', upstream_adapter)
+upstream.headers.update({'x-api-key': api_key})
+
 
 @app.route('/')
 def index():
@@ -91,11 +103,10 @@ def chat(source_id):
 
 
 def add_pdf_via_file(file_path):
-    headers = {'x-api-key': api_key}
     files = {'file': ('file', open(file_path, 'rb'), 'application/octet-stream')}
 
     try:
-        response = requests.post('https://api.chatpdf.com/v1/sources/add-file', headers=headers, files=files)
+        response = upstream.post(base_url + '/v1/sources/add-file', timeout=upstream_timeout, files=files)
 
         if response.status_code == 200:
             data = response.json()
@@ -111,14 +122,10 @@ def add_pdf_via_file(file_path):
 
 
 def add_pdf_via_url(url):
-    headers = {
-        'x-api-key': api_key,
-        'Content-Type': 'application/json'
-    }
     data = {'url': url}
 
     try:
-        response = requests.post('https://api.chatpdf.com/v1/sources/add-url', headers=headers, json=data)
+        response = upstream.post(base_url + '/v1/sources/add-url', timeout=upstream_timeout, json=data)
         response.raise_for_status()
         data = response.json()
         source_id = data['sourceId']
@@ -134,11 +141,6 @@ def add_pdf_via_url(url):
 
 
 def send_chat_message(source_id, user_message):
-    headers = {
-        'x-api-key': api_key,
-        'Content-Type': 'application/json'
-    }
-
     timestamp = format_timestamp()
 
     data = {
@@ -149,7 +151,7 @@ def send_chat_message(source_id, user_message):
     }
 
     try:
-        response = requests.post('https://api.chatpdf.com/v1/chats/message', headers=headers, json=data)
+        response = upstream.post(base_url + '/v1/chats/message', timeout=upstream_timeout, json=data)
 
         if response.status_code == 200:
             result = response.json()['content']
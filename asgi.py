@@ -0,0 +1,744 @@
+# ASGI entry point: `uvicorn asgi:app`
+#
+# The chat and upload routes run as coroutines against an async ChatPDF client, so one
+# process can hold many slow upstream calls at once. They still render through Flask
+# (templates, sessions, flash messages); every other route is served by the Flask app
+# in a thread.
+import asyncio
+import hashlib
+import io
+import os
+import secrets
+import tempfile
+import time
+
+import httpx
+from flask import Response, flash, jsonify, redirect, render_template, request, url_for
+from uvicorn.middleware.wsgi import WSGIMiddleware, build_environ
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+
+import deadlines
+import metrics
+import server_timing
+from admission import AdmissionController
+from answer_cache import normalize_question
+from bulkhead import Bulkhead
+from main import (
+    EMPTY_CHAT_MESSAGE, admission, answer_cache, api_keys, app as flask_app, base_urls, bind_new_source, bulkhead_full,
+    cache, chat_hedger, chat_history, chat_message, chat_request_token, check_chat_request, complete_chat_request,
+    format_timestamp, ingest_file, ingest_zip, quota_wait, record_hedge, reject_key, release_chat_request, retry_delay,
+    run_in_app_context, source_index, sse_event, sse_headers, submit_upload_job, upstream_breaker, upstream_headers,
+    upstream_kind, upstream_timeout, use_answer_cache, wants_job,
+)
+from resilience import RETRY_STATUSES
+from singleflight import AsyncSingleFlight
+from streaming_upload import AsyncMultipartReader, FieldTooLarge, async_multipart_file_body
+
+# Async upstream clients for chat and ingest calls, opened by the lifespan handler
+upstreams = {}
+
+# Identical upstream calls in flight at the same time share one request, keyed like main.singleflight
+singleflight = AsyncSingleFlight(time_left=deadlines.time_left)
+
+wsgi_app = WSGIMiddleware(flask_app)
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    async def handle_async_request(self, request):
+        # httpcore reports connection setup through the trace extension
+        events = {}
+
+        async def trace(event, info):
+            events[event] = time.perf_counter()
+
+        def phase(name):
+            started = events.get(f"connection.{name}.started")
+            return events.get(f"connection.{name}.complete", started) - started if started else 0.0
+
+        request.extensions['trace'] = trace
+        started = time.perf_counter()
+        with metrics.upstream_call(request.url.path) as call:
+            try:
+                response = await super().handle_async_request(request)
+            except asyncio.CancelledError:
+                call['status'] = 'cancelled'  # The losing attempt of a hedged call
+                raise
+            finally:
+                server_timing.record_upstream(
+                    time.perf_counter() - started, phase('connect_tcp'), phase('start_tls'),
+                )
+            call['status'] = str(response.status_code)
+            return response
+
+
+def create_async_upstream(pool_size):
+    return httpx.AsyncClient(
+        base_url=flask_app.config['CHATPDF_BASE_URL'],
+        transport=InstrumentedTransport(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        ),
+        timeout=httpx.Timeout(
+            flask_app.config['CHATPDF_READ_TIMEOUT'],
+            connect=flask_app.config['CHATPDF_CONNECT_TIMEOUT'],
+        ),
+    )
+
+
+class UpstreamUnavailable(httpx.TransportError):
+    pass
+
+
+async def upstream_send(path, idempotent=False, stream=False, source_id=None, **kwargs):
+    # Same key selection, retry, deadline and circuit breaker rules as main.upstream_post
+    call = metrics.upstream_call_name(path)
+    upstream = upstreams[upstream_kind(path)]
+    attempt = 0
+
+    while True:
+        key = await asyncio.to_thread(api_keys.choose, source_id)
+        if not upstream_breaker.allow():
+            metrics.UPSTREAM_SHORT_CIRCUITS.labels(call).inc()
+            raise UpstreamUnavailable(
+                f"ChatPDF is unavailable, try again in {upstream_breaker.retry_in():.0f}s."
+            )
+
+        # Anything but an outcome (the quota, a bad request body, the deadline, a cancelled
+        # hedge) still has to let the next half-open probe through
+        try:
+            wait = await asyncio.to_thread(quota_wait, path, key)
+            if wait is None:
+                raise UpstreamUnavailable('The ChatPDF request quota is used up, try again in a minute.')
+            if not deadlines.fits(wait):
+                raise deadlines.DeadlineExceeded()
+            await asyncio.sleep(wait)
+
+            base_url = base_urls.choose()
+            connect_timeout, read_timeout = upstream_timeout()
+            request = upstream.build_request('POST', base_url + path, **{
+                **kwargs,
+                'headers': upstream_headers(key, kwargs.get('headers')),
+                # Waiting for a pooled connection is bounded like connecting, as in main
+                'timeout': httpx.Timeout(read_timeout, connect=connect_timeout, pool=connect_timeout),
+            })
+            api_keys.acquire(key)
+            try:
+                response = await upstream.send(request, stream=stream)
+            except httpx.PoolTimeout:
+                deadlines.time_left()  # Out of time waiting for a connection: the deadline's 504
+                raise
+            except httpx.TransportError as e:
+                upstream_breaker.record_failure()
+                if isinstance(e, httpx.ConnectError):
+                    base_urls.eject(base_url)
+                deadlines.time_left()  # A timeout cut short by the deadline ends the request
+                delay = retry_delay(attempt) if idempotent else None
+                if delay is None:
+                    raise
+            else:
+                if response.status_code >= 500:
+                    upstream_breaker.record_failure()
+                else:
+                    upstream_breaker.record_success()
+
+                if reject_key(key, response) and idempotent and source_id is None and api_keys.healthy():
+                    await response.aclose()
+                    continue  # Fail over to another key straight away
+
+                if response.is_success and not stream:
+                    try:
+                        await asyncio.to_thread(bind_new_source, path, key, response.json())
+                    except ValueError:
+                        pass
+
+                if response.status_code not in RETRY_STATUSES or not idempotent:
+                    return response
+                delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                if delay is None:
+                    return response
+                await response.aclose()
+            finally:
+                api_keys.release(key)
+        except BaseException:
+            upstream_breaker.release()
+            raise
+
+        metrics.UPSTREAM_RETRIES.labels(call).inc()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def index(receive):
+    return render_template('index.html')
+
+
+async def upload_file(receive):
+    filename, chunks, claimed_digest, error_message = await open_upload(receive)
+
+    if not error_message and filename.lower().endswith('.zip'):
+        with tempfile.TemporaryFile() as spooled:
+            async for chunk in chunks:
+                spooled.write(chunk)
+            members, error_message = await asyncio.to_thread(run_in_app_context, ingest_zip, spooled, deadlines.current())
+        if not error_message:
+            return jsonify(status='done', members=members)
+
+    if error_message and wants_job():
+        return jsonify(status='error', error=error_message), 400
+
+    if not error_message and wants_job():
+        # Like the Flask route: the job outlives this request, so the file is spooled first
+        return submit_upload_job(ingest_file, *await save_upload(chunks))
+
+    if not error_message:
+        source_id, error_message = await stream_upload(chunks, claimed_digest)
+
+    if error_message:
+        flash(error_message, 'error')
+        return redirect(url_for('index'))
+
+    await asyncio.to_thread(chat_history.create, source_id)
+    flash('File uploaded successfully.', 'success')  # User feedback
+    return redirect(url_for('chat', source_id=source_id))
+
+
+async def upload_url(receive):
+    url = request.form['url']
+    source_id, error_message = await add_pdf_via_url(url)
+
+    if error_message:
+        flash(error_message, 'error')
+        return redirect(url_for('index'))
+
+    await asyncio.to_thread(chat_history.create, source_id)
+    flash('File uploaded successfully.', 'success')  # User feedback
+    return redirect(url_for('chat', source_id=source_id))
+
+
+async def claim_chat_request(source_id, token):
+    # Same as main.claim_chat_request, but a duplicate waits on the event loop instead of
+    # holding one of the default executor's few threads
+    if token is None:
+        return None
+    while True:
+        result = await asyncio.to_thread(check_chat_request, source_id, token)
+        if result == 'claimed':
+            return None
+        if result != 'pending':
+            return result
+        deadlines.time_left()
+        await asyncio.sleep(0.1)
+
+
+async def chat(receive, source_id):
+    if request.method == 'POST':
+        user_message = chat_message()
+        if user_message is None:
+            flash(EMPTY_CHAT_MESSAGE, 'error')
+            return redirect(url_for('chat', source_id=source_id), 303)
+
+        token = chat_request_token()
+        if await claim_chat_request(source_id, token) is None:
+            try:
+                chat_response, error_message = await answer_chat_message(source_id, user_message, use_answer_cache())
+            except BaseException:
+                await asyncio.to_thread(release_chat_request, source_id, token)
+                raise
+
+            if error_message:
+                await asyncio.to_thread(release_chat_request, source_id, token)
+                flash(error_message, 'error')
+            else:
+                timestamp = format_timestamp()
+                await asyncio.to_thread(chat_history.append, source_id, [
+                    {'role': 'user', 'content': user_message, 'timestamp': timestamp},
+                    {'role': 'assistant', 'content': chat_response, 'timestamp': timestamp},
+                ])
+                await asyncio.to_thread(complete_chat_request, source_id, token, chat_response, timestamp)
+
+        return redirect(url_for('chat', source_id=source_id), 303)
+
+    history = await asyncio.to_thread(chat_history.get, source_id)
+    return render_template('chat.html', source_id=source_id, history=history, request_token=secrets.token_urlsafe(16))
+
+
+async def chat_stream(receive, source_id):
+    user_message = chat_message()
+    if user_message is None:
+        return Response(EMPTY_CHAT_MESSAGE, 400, mimetype='text/plain')
+    cached = use_answer_cache()
+    token = chat_request_token()
+
+    async def events():
+        earlier = await claim_chat_request(source_id, token)
+        if earlier is not None:
+            yield sse_event('token', earlier['answer'])
+            yield sse_event('done', earlier['timestamp'])
+            return
+
+        try:
+            async for event in answer_events():
+                yield event
+        except BaseException:
+            await asyncio.to_thread(release_chat_request, source_id, token)
+            raise
+
+    async def answer_events():
+        answer = answer_cache.get(source_id, user_message) if cached else None
+
+        if answer is not None:
+            yield sse_event('token', answer)
+        else:
+            chunks = []
+            try:
+                async for chunk in stream_chat_message(source_id, user_message):
+                    chunks.append(chunk)
+                    yield sse_event('token', chunk)
+            except httpx.HTTPError as e:
+                await asyncio.to_thread(release_chat_request, source_id, token)
+                yield sse_event('error', f"Error sending chat message: {str(e)}")
+                return
+            except deadlines.DeadlineExceeded as e:
+                await asyncio.to_thread(release_chat_request, source_id, token)
+                yield sse_event('error', e.description)
+                return
+
+            answer = ''.join(chunks)
+            if cached:
+                answer_cache.put(source_id, user_message, answer)
+
+        timestamp = format_timestamp()
+        await asyncio.to_thread(chat_history.append, source_id, [
+            {'role': 'user', 'content': user_message, 'timestamp': timestamp},
+            {'role': 'assistant', 'content': answer, 'timestamp': timestamp},
+        ])
+        await asyncio.to_thread(complete_chat_request, source_id, token, answer, timestamp)
+        yield sse_event('done', timestamp)
+
+    # app() sends async generator bodies as they are produced
+    return Response(events(), mimetype='text/event-stream', headers=sse_headers)
+
+
+async def open_upload(receive):
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return None, None, None, 'No file selected.'
+
+    reader = AsyncMultipartReader(receive, boundary, flask_app.config['ZIP_MAX_CONTENT_LENGTH'])
+    claimed_digest = None
+
+    async for name, filename in reader.parts():
+        if name == 'content_sha256' and filename is None:
+            try:
+                claimed_digest = await reader.read_field()
+            except FieldTooLarge:
+                return None, None, None, 'Invalid file checksum.'
+        elif name == 'file' and filename is not None:
+            break
+    else:
+        return None, None, None, 'No file selected.'
+
+    if filename == '':
+        return None, None, None, 'Please select a valid file.'
+
+    chunks = count_upload_bytes(reader.iter_data())
+    if not filename.lower().endswith('.zip'):
+        chunks = limit_size(chunks, flask_app.config['MAX_CONTENT_LENGTH'])
+    return filename, chunks, claimed_digest, None
+
+
+async def count_upload_bytes(chunks):
+    counter = metrics.UPLOAD_BYTES.labels(request.endpoint)
+    async for chunk in chunks:
+        counter.inc(len(chunk))
+        yield chunk
+
+
+async def limit_size(chunks, max_size):
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > max_size:
+            raise RequestEntityTooLarge()
+        yield chunk
+
+
+async def reuse_source(chunks, claimed_digest, source_id):
+    # Same check as main.reuse_source: the client's digest has to match what it sent
+    digest = hashlib.sha256()
+    async for chunk in chunks:
+        digest.update(chunk)
+    if digest.hexdigest() != claimed_digest:
+        return None, 'The uploaded file does not match its checksum. Please try again.'
+    flask_app.logger.debug(f"Reusing source {source_id} for upload {claimed_digest}")
+    return source_id, None
+
+
+async def stream_upload(chunks, claimed_digest):
+    source_id = await asyncio.to_thread(source_index.get, claimed_digest) if claimed_digest else None
+    if source_id:
+        return await reuse_source(chunks, claimed_digest, source_id)
+
+    uploaded = False
+
+    async def upload():
+        nonlocal uploaded
+        uploaded = True
+        digest = hashlib.sha256()
+
+        async def hashed_chunks():
+            async for chunk in chunks:
+                digest.update(chunk)
+                yield chunk
+
+        source_id, error_message = await add_pdf_via_stream(hashed_chunks())
+        if source_id:
+            # Only digests computed here go into the index
+            await asyncio.to_thread(source_index.put, digest.hexdigest(), source_id)
+            if claimed_digest and digest.hexdigest() != claimed_digest:
+                # Callers waiting on the claimed digest must not get another file's source
+                return None, 'The uploaded file does not match its checksum. Please try again.'
+        return source_id, error_message
+
+    # Same as main.stream_upload: concurrent uploads of the same PDF wait for the first one
+    if not claimed_digest:
+        return await upload()
+    source_id, error_message = await singleflight.do(('add-file', claimed_digest), upload)
+    if uploaded or not source_id:
+        return source_id, error_message
+    return await reuse_source(chunks, claimed_digest, source_id)
+
+
+async def save_upload(chunks):
+    # Same as main.save_upload, for a body read from the ASGI receive channel
+    digest = hashlib.sha256()
+    partial_path = os.path.join(flask_app.config['UPLOAD_FOLDER'], f".{secrets.token_hex(8)}.part")
+
+    try:
+        with open(partial_path, 'wb') as out:
+            async for chunk in chunks:
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(partial_path)
+        raise
+
+    digest = digest.hexdigest()
+    file_path = os.path.join(flask_app.config['UPLOAD_FOLDER'], f"{digest}-{secrets.token_hex(4)}.pdf")
+    os.replace(partial_path, file_path)
+    return file_path, digest
+
+
+async def add_pdf_via_stream(chunks):
+    body, content_type = async_multipart_file_body(chunks)
+
+    try:
+        response = await upstream_send('/v1/sources/add-file', content=body, headers={'Content-Type': content_type})
+        response.raise_for_status()
+        data = response.json()
+        source_id = data.get('sourceId')
+        return source_id, None
+
+    except httpx.HTTPError as e:
+        error_message = f"Error uploading file: {str(e)}"
+        return None, error_message
+
+    except ValueError as e:  # Malformed multipart body from the browser
+        error_message = f"Error uploading file: {str(e)}"
+        return None, error_message
+
+
+async def add_pdf_via_url(url):
+    # Same 50 second cache of API responses as main.add_pdf_via_url
+    key = f"upload_url:{url}"
+    result = cache.get(key)
+    metrics.CACHE_LOOKUPS.labels('upload_url', 'miss' if result is None else 'hit').inc()
+    if result is None:
+        result = await singleflight.do(('add-url', url), request_add_url, url)
+        cache.set(key, result, timeout=50)
+    return result
+
+
+async def request_add_url(url):
+    data = {'url': url}
+
+    try:
+        response = await upstream_send('/v1/sources/add-url', idempotent=True, json=data)
+        response.raise_for_status()
+        data = response.json()
+        source_id = data['sourceId']
+        return source_id, None
+
+    except httpx.HTTPError as e:
+        error_message = f"Error uploading file: {str(e)}"
+        return None, error_message
+
+    except KeyError:
+        error_message = "Invalid response from the API. Missing 'sourceId' key."
+        return None, error_message
+
+
+async def answer_chat_message(source_id, user_message, cached=True):
+    if cached:
+        chat_response = answer_cache.get(source_id, user_message)
+        if chat_response is not None:
+            return chat_response, None
+
+    chat_response, error_message = await send_chat_message(source_id, user_message)
+
+    if cached and not error_message:
+        answer_cache.put(source_id, user_message, chat_response)
+    return chat_response, error_message
+
+
+async def send_chat_message(source_id, user_message):
+    return await singleflight.do(
+        ('chat', source_id, normalize_question(user_message)), request_chat_message, source_id, user_message,
+    )
+
+
+async def request_chat_message(source_id, user_message):
+    timestamp = format_timestamp()
+
+    data = {
+        'sourceId': source_id,
+        'messages': [
+            {'role': 'user', 'content': user_message, 'timestamp': timestamp}
+        ]
+    }
+
+    try:
+        if flask_app.config['CHAT_HEDGE_ENABLED']:
+            result = await hedged(request_chat_answer, data)
+        else:
+            result = await request_chat_answer(data)
+        return result, None
+
+    except httpx.HTTPError as e:
+        error_message = f"Error sending chat message: {str(e)}"
+        return None, error_message
+
+
+async def request_chat_answer(data):
+    response = await upstream_send('/v1/chats/message', idempotent=True, source_id=data['sourceId'], json=data)
+    response.raise_for_status()
+    return response.json()['content']
+
+
+async def hedged(fn, *args):
+    # Async counterpart of Hedger.call; here the losing attempt is cancelled outright
+    async def attempt():
+        started = time.perf_counter()
+        result = await fn(*args)
+        chat_hedger.observe(time.perf_counter() - started)
+        return result
+
+    chat_hedger.earn()
+    attempts = [asyncio.ensure_future(attempt())]
+    delay = chat_hedger.delay()
+
+    if delay is not None:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if not done and chat_hedger.spend():
+            attempts.append(asyncio.ensure_future(attempt()))
+
+    pending = set(attempts)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if len(attempts) > 1:
+                        record_hedge('hedge' if task is attempts[1] else 'primary')
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def stream_chat_message(source_id, user_message):
+    data = {
+        'sourceId': source_id,
+        'stream': True,
+        'messages': [
+            {'role': 'user', 'content': user_message, 'timestamp': format_timestamp()}
+        ]
+    }
+
+    response = await upstream_send('/v1/chats/message', idempotent=True, stream=True, source_id=data['sourceId'], json=data)
+    try:
+        response.raise_for_status()
+        async for chunk in response.aiter_text():
+            deadlines.time_left()
+            if chunk:
+                yield chunk
+    finally:
+        await response.aclose()
+
+
+# Flask endpoints served natively by this module
+async_views = {
+    'index': index,
+    'upload_file': upload_file,
+    'upload_url': upload_url,
+    'chat': chat,
+    'chat_stream': chat_stream,
+}
+
+# Endpoints that read the request body themselves instead of having it buffered
+streaming_views = {'upload_file'}
+
+# POSTs to these endpoints hold a bulkhead slot until their response has been sent. The
+# limits are this server's own: a queued or running request here costs a coroutine and a
+# pooled connection rather than a worker thread.
+ingest_bulkhead = Bulkhead(
+    'ingest', flask_app.config['ASYNC_INGEST_CONCURRENCY'], flask_app.config['INGEST_QUEUE_SIZE'],
+    flask_app.config['INGEST_QUEUE_TIMEOUT'],
+)
+chat_bulkhead = Bulkhead(
+    'chat', flask_app.config['ASYNC_CHAT_CONCURRENCY'], flask_app.config['CHAT_QUEUE_SIZE'],
+    flask_app.config['CHAT_QUEUE_TIMEOUT'],
+)
+
+# Admission for this server's routes and the Flask ones alike, with this server's own limit
+admission.controller = AdmissionController(
+    flask_app.config['ADMISSION_TARGET_DELAY'],
+    flask_app.config['ADMISSION_INTERVAL'],
+    flask_app.config['ADMISSION_MIN_LIMIT'],
+    flask_app.config['ASYNC_ADMISSION_MAX_LIMIT'],
+    client_share=flask_app.config['ADMISSION_CLIENT_SHARE'],
+)
+
+view_bulkheads = {
+    'upload_file': ingest_bulkhead,
+    'upload_url': ingest_bulkhead,
+    'chat': chat_bulkhead,
+    'chat_stream': chat_bulkhead,
+}
+
+
+async def acquire_bulkhead(bulkhead):
+    # Polls for a slot so that queued requests do not each hold a thread
+    if bulkhead.try_acquire():
+        return True
+    if not bulkhead.enqueue():
+        return False
+    try:
+        deadline = time.monotonic() + bulkhead.timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+            if bulkhead.try_acquire():
+                return True
+        return False
+    finally:
+        bulkhead.dequeue()
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if len(body) > flask_app.config['MAX_CONTENT_LENGTH']:
+            raise RequestEntityTooLarge()
+    return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Like the Flask sessions, each pool has room for its bulkhead's calls; ZIP members
+            # run in threads and use the Flask ingest session
+            hedged = 2 if flask_app.config['CHAT_HEDGE_ENABLED'] else 1
+            upstreams['chat'] = create_async_upstream(flask_app.config['ASYNC_CHAT_CONCURRENCY'] * hedged)
+            upstreams['ingest'] = create_async_upstream(flask_app.config['ASYNC_INGEST_CONCURRENCY'])
+            for upstream in upstreams.values():
+                try:
+                    await upstream.head('/')
+                except httpx.HTTPError as e:
+                    flask_app.logger.warning(f"Could not warm upstream connection: {str(e)}")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for upstream in upstreams.values():
+                await upstream.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    environ = build_environ(scope, {}, io.BytesIO())
+    try:
+        endpoint, view_args = flask_app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        endpoint, view_args = None, {}
+
+    view = async_views.get(endpoint)
+    if view is None:
+        await wsgi_app(scope, receive, send)
+        return
+
+    # Other routes pass through the same admission middleware inside wsgi_app
+    if flask_app.config['ADMISSION_ENABLED'] and not admission.exempt(environ):
+        client, reason = admission.admit(environ)
+        if reason is not None:
+            status, headers, body = admission.rejection()
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split()[0]),
+                'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers],
+            })
+            await send({'type': 'http.response.body', 'body': body})
+            return
+    else:
+        client = None
+
+    bulkhead = view_bulkheads.get(endpoint) if scope['method'] not in ('GET', 'HEAD') else None
+    acquired = False
+
+    try:
+        acquired = bulkhead is None or await acquire_bulkhead(bulkhead)
+        with flask_app.request_context(environ):
+            try:
+                if acquired and endpoint not in streaming_views:
+                    environ['wsgi.input'] = io.BytesIO(await read_body(receive))
+                rv = flask_app.preprocess_request()
+                if rv is None:
+                    if not acquired:
+                        raise bulkhead_full(bulkhead)
+                    rv = await view(receive, **view_args)
+            except HTTPException as e:
+                rv = flask_app.handle_user_exception(e)
+            except Exception as e:
+                rv = flask_app.handle_exception(e)
+            await send_response(send, rv)
+    finally:
+        if bulkhead is not None and acquired:
+            bulkhead.release()
+        if client is not None:
+            admission.controller.release(client)
+
+
+async def send_response(send, rv):
+    # Must run inside the request context
+    response = flask_app.process_response(flask_app.make_response(rv))
+
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in response.headers.items()],
+    })
+    if hasattr(response.response, '__aiter__'):
+        async for chunk in response.response:
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+    else:
+        for chunk in response.iter_encoded():
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
@@ -0,0 +1,66 @@
+import math
+import threading
+
+
+class Bulkhead:
+    # Bounded concurrency for one kind of work in this worker process: at most `limit`
+    # callers hold a slot, at most `max_queue` more wait for one, and a waiting caller
+    # gives up after `timeout` seconds. Callers that get no slot should shed the request.
+
+    def __init__(self, name, limit, max_queue, timeout):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def retry_after(self):
+        # Whole seconds a shed client should wait before trying again
+        return max(1, math.ceil(self.timeout))
+
+    def try_acquire(self):
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            return False
+
+    def enqueue(self):
+        # Joins the queue of waiting callers; False when it is full
+        with self._cond:
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            return True
+
+    def dequeue(self):
+        with self._cond:
+            self.waiting -= 1
+
+    def acquire(self, background=False):
+        # Waits up to self.timeout for a slot. Background jobs were already accepted, so they
+        # wait for as long as it takes, without the queue cap.
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if not background and self.waiting >= self.max_queue:
+                return False
+
+            self.waiting += 1
+            try:
+                acquired = self._cond.wait_for(
+                    lambda: self.active < self.limit, None if background else self.timeout,
+                )
+            finally:
+                self.waiting -= 1
+            if acquired:
+                self.active += 1
+            return acquired
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
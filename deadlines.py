@@ -0,0 +1,51 @@
+import time
+
+from flask import g, has_app_context
+from werkzeug.exceptions import GatewayTimeout
+
+# Per-request time budgets. The deadline is set when the request comes in and lives in
+# flask.g, so hedged attempts and threads started with a copied context see it too;
+# background jobs run in their own app context and have no deadline.
+
+
+class DeadlineExceeded(GatewayTimeout):
+    description = 'The request took too long to complete. Please try again.'
+
+
+def start(seconds):
+    # No deadline for 0 or None
+    g.deadline = time.monotonic() + seconds if seconds else None
+
+
+def current():
+    # The deadline itself (a time.monotonic() value), for handing work to other threads
+    return g.get('deadline') if has_app_context() else None
+
+
+def resume(deadline):
+    # Holds the current app context, e.g. one a worker thread pushed, to a deadline from current()
+    g.deadline = deadline
+
+
+def time_left():
+    # Seconds left for the current request, or None without a deadline; raises
+    # DeadlineExceeded once the deadline has passed
+    deadline = g.get('deadline') if has_app_context() else None
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left
+
+
+def clamp(seconds):
+    # The given timeout, shortened to what is left of the request's budget
+    left = time_left()
+    return seconds if left is None else min(seconds, left)
+
+
+def fits(seconds):
+    # Whether waiting this long still leaves time to do something afterwards
+    left = time_left()
+    return left is None or seconds < left
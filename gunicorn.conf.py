@@ -0,0 +1,18 @@
+# Gunicorn reads this file automatically when started from the app directory
+import os
+import tempfile
+
+# Workers write their Prometheus samples here so /metrics can add them up
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', tempfile.mkdtemp(prefix='chatpdf-metrics-'))
+
+
+def post_worker_init(worker):
+    # Open the pooled ChatPDF connection as soon as the worker boots
+    from main import warm_upstream
+    warm_upstream()
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's in-flight gauges from the totals
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
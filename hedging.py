@@ -0,0 +1,84 @@
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+class Hedger:
+    # Sends a second, identical request when the first is slower than the given percentile
+    # of recent successful calls, and keeps whichever answers first. Every call earns
+    # `budget` hedge tokens (up to max_tokens) and every hedge spends one, so hedges stay
+    # below that share of calls. No hedging happens until min_samples latencies are known.
+
+    def __init__(self, executor, percentile, budget, min_delay, window=200, min_samples=20, max_tokens=10):
+        self.executor = executor
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self._latencies = deque(maxlen=window)
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self):
+        # Seconds to wait for the first attempt before hedging, or None to never hedge
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return max(self.min_delay, latencies[int(self.percentile * (len(latencies) - 1))])
+
+    def earn(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.budget)
+
+    def spend(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _submit(self, fn, args):
+        # Attempts run in pool threads but still see the caller's request context
+        started = time.perf_counter()
+
+        def finished(future):
+            if not future.cancelled() and future.exception() is None:
+                self.observe(time.perf_counter() - started)
+
+        future = self.executor.submit(contextvars.copy_context().run, fn, *args)
+        future.add_done_callback(finished)
+        return future
+
+    def call(self, fn, *args, on_hedge=None):
+        # Returns fn's result from the first attempt that succeeds, or raises the last error.
+        # A losing attempt cannot be interrupted; it finishes in its thread and is ignored.
+        self.earn()
+        attempts = [self._submit(fn, args)]
+        delay = self.delay()
+
+        if delay is not None:
+            done, _ = wait(attempts, timeout=delay)
+            if not done and self.spend():
+                attempts.append(self._submit(fn, args))
+
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if on_hedge and len(attempts) > 1:
+                        on_hedge('hedge' if future is attempts[1] else 'primary')
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
@@ -0,0 +1,227 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from memcache_client import get_memcached
+from shared_store import memcached_expiry
+
+
+class MemoryHistoryStore:
+    # Per-process LRU of conversations; only suitable for a single worker
+
+    def __init__(self, max_messages, max_conversations, ttl):
+        self.max_messages = max_messages
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, source_id):
+        entry = self._conversations.get(source_id)
+        if entry is None:
+            return None
+        if time.time() - entry[1] > self.ttl:
+            del self._conversations[source_id]
+            return None
+        self._conversations.move_to_end(source_id)
+        return entry[0]
+
+    def _store(self, source_id, messages):
+        self._conversations[source_id] = (messages[-self.max_messages:], time.time())
+        self._conversations.move_to_end(source_id)
+        while len(self._conversations) > self.max_conversations:
+            self._conversations.popitem(last=False)
+
+    def get(self, source_id):
+        with self._lock:
+            return list(self._lookup(source_id) or [])
+
+    def create(self, source_id):
+        with self._lock:
+            if self._lookup(source_id) is None:
+                self._store(source_id, [])
+
+    def append(self, source_id, messages):
+        with self._lock:
+            history = ((self._lookup(source_id) or []) + list(messages))[-self.max_messages:]
+            self._store(source_id, history)
+            return list(history)
+
+    def size(self):
+        return len(self._conversations)
+
+
+class SQLiteHistoryStore:
+    # Conversations in a WAL-mode SQLite file, shared by every worker on the instance
+
+    def __init__(self, path, max_messages, max_conversations, ttl):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS conversations ('
+                'source_id TEXT PRIMARY KEY, updated_at REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, source_id TEXT NOT NULL, '
+                'role TEXT NOT NULL, content TEXT NOT NULL, timestamp TEXT NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS messages_source ON messages (source_id, id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated_at)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def _messages(self, conn, source_id):
+        rows = conn.execute(
+            'SELECT role, content, timestamp FROM messages WHERE source_id = ? ORDER BY id',
+            (source_id,)
+        ).fetchall()
+        return [{'role': role, 'content': content, 'timestamp': timestamp} for role, content, timestamp in rows]
+
+    def _evict(self, conn):
+        expired = time.time() - self.ttl
+        conn.execute(
+            'DELETE FROM messages WHERE source_id IN '
+            '(SELECT source_id FROM conversations WHERE updated_at < ?)',
+            (expired,)
+        )
+        conn.execute('DELETE FROM conversations WHERE updated_at < ?', (expired,))
+
+        overflow = conn.execute('SELECT COUNT(*) FROM conversations').fetchone()[0] - self.max_conversations
+        if overflow > 0:
+            stale = conn.execute(
+                'SELECT source_id FROM conversations ORDER BY updated_at LIMIT ?', (overflow,)
+            ).fetchall()
+            conn.executemany('DELETE FROM messages WHERE source_id = ?', stale)
+            conn.executemany('DELETE FROM conversations WHERE source_id = ?', stale)
+
+    def get(self, source_id):
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute(
+                    'SELECT updated_at FROM conversations WHERE source_id = ?', (source_id,)
+                ).fetchone()
+                if row is None or time.time() - row[0] > self.ttl:
+                    return []
+                conn.execute(
+                    'UPDATE conversations SET updated_at = ? WHERE source_id = ?', (time.time(), source_id)
+                )
+                return self._messages(conn, source_id)
+        finally:
+            conn.close()
+
+    def create(self, source_id):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR IGNORE INTO conversations (source_id, updated_at) VALUES (?, ?)',
+                    (source_id, time.time())
+                )
+                self._evict(conn)
+        finally:
+            conn.close()
+
+    def append(self, source_id, messages):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO conversations (source_id, updated_at) VALUES (?, ?)',
+                    (source_id, time.time())
+                )
+                conn.executemany(
+                    'INSERT INTO messages (source_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
+                    [(source_id, m['role'], m['content'], m['timestamp']) for m in messages]
+                )
+                conn.execute(
+                    'DELETE FROM messages WHERE source_id = ? AND id NOT IN '
+                    '(SELECT id FROM messages WHERE source_id = ? ORDER BY id DESC LIMIT ?)',
+                    (source_id, source_id, self.max_messages)
+                )
+                self._evict(conn)
+                return self._messages(conn, source_id)
+        finally:
+            conn.close()
+
+    def size(self):
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+        finally:
+            conn.close()
+
+
+class MemcachedHistoryStore:
+    # Conversations as JSON blobs in memcached. The global cap is kept by creation order:
+    # new conversations take turns in max_conversations slots numbered by a shared counter,
+    # and each one evicts the conversation created max_conversations before it. memcached's
+    # own LRU may evict sooner.
+
+    key_prefix = 'history:'
+    counter_key = 'history-created'
+    slot_prefix = 'history-slot:'
+
+    def __init__(self, max_messages, max_conversations, ttl, cas_attempts=5):
+        self.max_messages = max_messages
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self.cas_attempts = cas_attempts
+
+    def _register(self, client, source_id):
+        slot = self.slot_prefix + str(client.incr(self.counter_key, 1) % self.max_conversations)
+        evicted = client.get(slot)
+        client.set(slot, source_id, time=0)
+        if evicted and evicted != source_id:
+            client.delete(self.key_prefix + evicted)
+
+    def get(self, source_id):
+        value = get_memcached().get(self.key_prefix + source_id)
+        return json.loads(value) if value else []
+
+    def create(self, source_id):
+        client = get_memcached()
+        if client.add(self.key_prefix + source_id, '[]', time=memcached_expiry(self.ttl)):
+            self._register(client, source_id)
+
+    def append(self, source_id, messages):
+        client = get_memcached()
+        key = self.key_prefix + source_id
+
+        # Compare-and-swap so concurrent turns from different workers are not lost
+        for _ in range(self.cas_attempts):
+            value, cas = client.gets(key)
+            history = (json.loads(value) if value else []) + list(messages)
+            history = history[-self.max_messages:]
+            if cas is None:
+                stored = client.add(key, json.dumps(history), time=memcached_expiry(self.ttl))
+                if stored:
+                    self._register(client, source_id)  # Expired or evicted, and started over
+            else:
+                stored = client.cas(key, json.dumps(history), cas, time=memcached_expiry(self.ttl))
+            if stored:
+                return history
+
+        client.set(key, json.dumps(history), time=memcached_expiry(self.ttl))
+        return history
+
+    def size(self):
+        return None  # Not tracked; memcached evicts on its own
+
+
+def create_history_store(backend, path, max_messages, max_conversations, ttl):
+    if backend == 'memory':
+        return MemoryHistoryStore(max_messages, max_conversations, ttl)
+    if backend == 'sqlite':
+        return SQLiteHistoryStore(path, max_messages, max_conversations, ttl)
+    if backend == 'memcached':
+        return MemcachedHistoryStore(max_messages, max_conversations, ttl)
+    raise ValueError(f"Unknown history backend: {backend}")
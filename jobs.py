@@ -0,0 +1,75 @@
+import json
+import logging
+import queue
+import secrets
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    # Bounded queue of upload jobs run by a fixed pool of threads. Job status lives in
+    # the shared store so any worker can answer a status poll.
+
+    key_prefix = 'job:'
+
+    def __init__(self, store, workers, max_queue, ttl, context=None):
+        self.store = store
+        self.workers = workers
+        self.ttl = ttl
+        self.context = context
+        self._queue = queue.Queue(max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Threads are started on first use so they belong to the worker process, not the master
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _set(self, job_id, job):
+        self.store.set(self.key_prefix + job_id, json.dumps(job), self.ttl)
+
+    def get(self, job_id):
+        value = self.store.get(self.key_prefix + job_id)
+        return json.loads(value) if value else None
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, fn, *args):
+        # Returns the new job id, or None when the queue is full
+        self._start()
+        job_id = secrets.token_urlsafe(16)
+        self._set(job_id, {'id': job_id, 'status': 'queued'})
+        try:
+            self._queue.put_nowait((job_id, fn, args))
+        except queue.Full:
+            self.store.delete(self.key_prefix + job_id)
+            return None
+        return job_id
+
+    def _work(self):
+        while True:
+            job_id, fn, args = self._queue.get()
+            self._set(job_id, {'id': job_id, 'status': 'running'})
+            try:
+                if self.context is not None:
+                    with self.context():
+                        source_id, error_message = fn(*args)
+                else:
+                    source_id, error_message = fn(*args)
+            except Exception:
+                logger.exception(f"Upload job {job_id} failed")
+                source_id, error_message = None, 'Unexpected error while processing the upload.'
+
+            if error_message:
+                self._set(job_id, {'id': job_id, 'status': 'error', 'error': error_message})
+            else:
+                self._set(job_id, {'id': job_id, 'status': 'done', 'source_id': source_id})
+            self._queue.task_done()
@@ -0,0 +1,218 @@
+import argparse
+import itertools
+import json
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Drives the app's routes at a fixed concurrency and reports throughput and latency per route.
+# Run it against an app pointed at stub_server.py, e.g.
+#   python loadtest.py --target http://127.0.0.1:5000 --concurrency 32 --duration 30
+
+ROUTES = ('index', 'upload', 'upload_url', 'chat', 'chat_stream')
+DEFAULT_MIX = 'index=1,upload=1,upload_url=1,chat=5'
+
+
+def parse_mix(spec):
+    # "route=weight,..." -> list of routes repeated by weight
+    mix = []
+    for item in spec.split(','):
+        route, _, weight = item.partition('=')
+        route = route.strip()
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f"Unknown route: {route}")
+        mix.extend([route] * int(weight or 1))
+    if not mix:
+        raise argparse.ArgumentTypeError('The route mix is empty.')
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def pdf_bytes(unique):
+    # Tiny stand-in PDF; a random trailer defeats the upload dedup when asked to
+    body = b'%PDF-1.4\n1 0 obj << /Type /Catalog >> endobj\ntrailer << /Root 1 0 R >>\n%%EOF\n'
+    return body + (b'%' + secrets.token_hex(8).encode() + b'\n' if unique else b'')
+
+
+class LoadClient:
+    # One keep-alive session per load thread
+
+    def __init__(self, target, unique, timeout):
+        self.target = target.rstrip('/')
+        self.unique = unique
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def post(self, path, **kwargs):
+        return self.session.post(self.target + path, allow_redirects=False, timeout=self.timeout, **kwargs)
+
+    def upload(self):
+        files = {'file': ('loadtest.pdf', pdf_bytes(self.unique), 'application/pdf')}
+        response = self.post('/upload', files=files)
+        return self.source_from_redirect(response)
+
+    def upload_url(self):
+        url = 'https://example.com/loadtest.pdf'
+        if self.unique:
+            url += f"?n={secrets.token_hex(8)}"
+        response = self.post('/upload_url', data={'url': url})
+        return self.source_from_redirect(response)
+
+    def source_from_redirect(self, response):
+        # Successful uploads redirect to /chat/<sourceId>; failures flash and redirect to /
+        location = response.headers.get('Location', '')
+        if response.status_code == 302 and '/chat/' in location:
+            return location.rsplit('/chat/', 1)[1]
+        return None
+
+    def question(self):
+        if self.unique:
+            return f"What does section {secrets.token_hex(4)} say?"
+        return 'What is this document about?'
+
+    def run(self, route, source_id):
+        if route == 'index':
+            response = self.session.get(self.target + '/', timeout=self.timeout)
+            return response.status_code == 200
+
+        if route == 'upload':
+            return self.upload() is not None
+
+        if route == 'upload_url':
+            return self.upload_url() is not None
+
+        question = self.question()
+        if route == 'chat':
+            # Like a browser: post the form with its one-time token, then follow the redirect
+            form = {'user_message': question, 'request_token': secrets.token_urlsafe(16)}
+            response = self.post(f"/chat/{source_id}", data=form)
+            if response.status_code != 303:
+                return False
+            response = self.session.get(self.target + response.headers['Location'], timeout=self.timeout)
+            # Chat errors still render the page, just without the new exchange
+            return response.status_code == 200 and question in response.text
+
+        with self.post(f"/chat/{source_id}/stream", data={'user_message': question}, stream=True) as response:
+            body = b''.join(response.iter_content(chunk_size=None))
+        return response.status_code == 200 and b'event: done' in body
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'throughput': count / elapsed if elapsed else 0.0,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+        }
+
+
+def run_load(target, mix, concurrency, duration=None, requests_total=None, unique=True, timeout=60):
+    # Runs for `duration` seconds or until `requests_total` requests were sent, whichever comes first
+    seed = LoadClient(target, unique=True, timeout=timeout)
+    source_id = None
+    for _ in range(5):  # The stub may be injecting failures
+        source_id = seed.upload()
+        if source_id:
+            break
+    if source_id is None:
+        raise RuntimeError(f"Could not upload a seed document to {target}")
+
+    stats = {route: RouteStats() for route in set(mix)}
+    lock = threading.Lock()
+    schedule = itertools.cycle(mix)
+    sent = itertools.count()
+    deadline = time.monotonic() + duration if duration else None
+
+    def next_route():
+        with lock:
+            if requests_total is not None and next(sent) >= requests_total:
+                return None
+            return next(schedule)
+
+    def worker():
+        client = LoadClient(target, unique, timeout)
+        while deadline is None or time.monotonic() < deadline:
+            route = next_route()
+            if route is None:
+                return
+            started = time.perf_counter()
+            try:
+                ok = client.run(route, source_id)
+            except requests.exceptions.RequestException:
+                ok = False
+            latency = time.perf_counter() - started
+            with lock:
+                stats[route].latencies.append(latency)
+                if not ok:
+                    stats[route].errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'target': target,
+        'concurrency': concurrency,
+        'elapsed': elapsed,
+        'routes': {route: route_stats.report(elapsed) for route, route_stats in sorted(stats.items())},
+    }
+
+
+def format_report(result):
+    def ms(value):
+        return '-' if value is None else f"{value * 1000:.1f}"
+
+    lines = [
+        f"{result['target']}  concurrency={result['concurrency']}  elapsed={result['elapsed']:.1f}s",
+        f"{'route':<12}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+    ]
+    for route, row in result['routes'].items():
+        lines.append(
+            f"{route:<12}{row['requests']:>10}{row['errors']:>8}{row['throughput']:>9.1f}"
+            f"{ms(row['p50']):>10}{ms(row['p95']):>10}{ms(row['p99']):>10}{ms(row['max']):>10}"
+        )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the ChatPDF app')
+    parser.add_argument('--target', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('--requests', type=int, help='stop after this many requests')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"weighted routes out of {', '.join(ROUTES)} (default {DEFAULT_MIX})")
+    parser.add_argument('--repeat', action='store_true',
+                        help='reuse the same PDF, URL and question so dedup and caches can hit')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', action='store_true', help='print the raw results as JSON')
+    args = parser.parse_args()
+
+    result = run_load(args.target, args.mix, args.concurrency, args.duration, args.requests,
+                      unique=not args.repeat, timeout=args.timeout)
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,61 @@
 import os
+import functools
+import hashlib
+import json
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import EmptyPoolError
+from urllib3.util import Timeout
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, Request, Response, g, render_template, request, redirect, url_for, flash, jsonify, stream_with_context
+from flask import before_render_template, template_rendered
 from dotenv import load_dotenv
-from werkzeug.utils import secure_filename
 from flask_caching import Cache
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, ServiceUnavailable
 import logging
 import secrets
-
-# Initialize chat_history as an empty dictionary
-chat_history = {}
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+import deadlines
+import metrics
+import server_timing
+from admission import AdmissionController, AdmissionMiddleware
+from answer_cache import AnswerCache, SimilarQuestionIndex, normalize_question
+from bulkhead import Bulkhead
+from hedging import Hedger
+from history_store import create_history_store
+from jobs import JobQueue
+from rate_limiter import TokenBucket
+from request_profiler import RequestProfiler
+from resilience import RETRY_STATUSES, CircuitBreaker, RetryPolicy, retry_after_seconds
+from shared_store import create_shared_store
+from singleflight import SingleFlight
+from source_index import SourceIndex
+from streaming_upload import FieldTooLarge, MultipartReader, multipart_file_body
+from upstream_pool import BaseUrls, KeyPool
 
 # Load environment variables from a .env file (if it exists)
 load_dotenv()
 
+
+class UploadRequest(Request):
+    @property
+    def max_content_length(self):
+        # Batches and ZIP archives carry many PDFs in one body; single PDFs are
+        # held to MAX_CONTENT_LENGTH as they are read
+        if self.endpoint == 'upload_batch':
+            return app.config['BATCH_MAX_CONTENT_LENGTH']
+        if self.endpoint == 'upload_file':
+            return app.config['ZIP_MAX_CONTENT_LENGTH']
+        return super().max_content_length
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 
 # Generate a secure secret key
 app.secret_key = secrets.token_urlsafe(32)
@@ -22,18 +63,655 @@ app.secret_key = secrets.token_urlsafe(32)
 # Set the logging level for your app
 app.logger.setLevel(logging.DEBUG)  # Change to a higher level in production
 
+# Requests slower than this many seconds are logged as JSON lines with their phase timings; 0 disables
+app.config['SLOW_REQUEST_THRESHOLD'] = float(os.getenv('SLOW_REQUEST_THRESHOLD', 2))
+app.config['SLOW_REQUEST_LOG'] = os.getenv('SLOW_REQUEST_LOG')  # File path; stderr when unset
+slow_request_log = logging.getLogger('chatpdf.slow_requests')
+slow_request_log.setLevel(logging.INFO)
+slow_request_log.propagate = False
+slow_request_log.addHandler(
+    logging.FileHandler(app.config['SLOW_REQUEST_LOG']) if app.config['SLOW_REQUEST_LOG'] else logging.StreamHandler()
+)
+
+# Profile a single request by sending "X-Profile: 1" (or ?profile=1) together with
+# "X-Profile-Token: <PROFILER_TOKEN>". Without PROFILER_TOKEN no profiling hooks are installed.
+app.config['PROFILER_TOKEN'] = os.getenv('PROFILER_TOKEN')
+app.config['PROFILE_FOLDER'] = os.path.join(app.instance_path, 'profiles')
+
 # Configure upload settings
 uploads_dir = os.path.join(app.instance_path, 'uploads')
 os.makedirs(uploads_dir, exist_ok=True)
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # Limit file size (consider your use case)
 app.config['UPLOAD_FOLDER'] = uploads_dir
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.getenv('UPLOAD_CHUNK_SIZE', 64 * 1024))  # Bytes held in memory per upload
+# Uploads are piped straight to ChatPDF by default; set to true to save them under UPLOAD_FOLDER first
+app.config['UPLOAD_SPOOL_TO_DISK'] = os.getenv('UPLOAD_SPOOL_TO_DISK', 'false').lower() == 'true'
+app.config['BATCH_MAX_CONTENT_LENGTH'] = int(os.getenv('BATCH_MAX_CONTENT_LENGTH', 1024 * 1024 * 1024))
+app.config['BATCH_MAX_ITEMS'] = int(os.getenv('BATCH_MAX_ITEMS', 500))
+app.config['BATCH_CONCURRENCY'] = int(os.getenv('BATCH_CONCURRENCY', 8))  # Parallel ingests per worker process
+app.config['ZIP_MAX_CONTENT_LENGTH'] = int(os.getenv('ZIP_MAX_CONTENT_LENGTH', 100 * 1024 * 1024))  # Compressed
+app.config['ZIP_MAX_MEMBER_SIZE'] = int(os.getenv('ZIP_MAX_MEMBER_SIZE', 10 * 1024 * 1024))  # Uncompressed, per PDF
+app.config['ZIP_MAX_TOTAL_SIZE'] = int(os.getenv('ZIP_MAX_TOTAL_SIZE', 200 * 1024 * 1024))  # Uncompressed, per archive
+
+# ChatPDF API keys: a comma-separated CHATPDF_API_KEYS, or the single CHATPDF_API_KEY.
+# Sources created before a key pool was configured are served by the first key.
+app.config['CHATPDF_API_KEYS'] = [
+    key.strip() for key in os.getenv('CHATPDF_API_KEYS', os.getenv('CHATPDF_API_KEY') or '').split(',') if key.strip()
+]
+app.config['CHATPDF_KEY_EJECT_SECONDS'] = float(os.getenv('CHATPDF_KEY_EJECT_SECONDS', 60))  # After a 401/429
+
+# Time budget of a request in seconds, from arrival to its last upstream call. Upstream
+# timeouts are cut to what is left, retries stop when it is used up, and the request then
+# ends with a 504. REQUEST_DEADLINES overrides it per endpoint, e.g. "chat=30,upload_file=180";
+# 0 means no deadline.
+app.config['REQUEST_DEADLINE'] = float(os.getenv('REQUEST_DEADLINE', 60))
+app.config['REQUEST_DEADLINES'] = {
+    'upload_file': 120.0,
+    'upload_url': 120.0,
+    'upload_batch': 0.0,  # Its items are ingested in the background
+    **{
+        endpoint.strip(): float(seconds)
+        for endpoint, seconds in (item.split('=') for item in os.getenv('REQUEST_DEADLINES', '').split(',') if item.strip())
+    },
+}
 
-# Get the API key from the environment variable
-api_key = os.getenv('CHATPDF_API_KEY')
+# Configure the upstream ChatPDF client
+app.config['CHATPDF_BASE_URL'] = os.getenv('CHATPDF_BASE_URL', 'https://api.chatpdf.com').rstrip('/')
+# Comma-separated base URLs used while CHATPDF_BASE_URL cannot be connected to
+app.config['CHATPDF_FALLBACK_BASE_URLS'] = [
+    url.strip().rstrip('/') for url in os.getenv('CHATPDF_FALLBACK_BASE_URLS', '').split(',') if url.strip()
+]
+app.config['CHATPDF_POOL_SIZE'] = int(os.getenv('CHATPDF_POOL_SIZE', 10))  # Chat turns per worker, see CHAT_CONCURRENCY
+app.config['CHATPDF_ASYNC_POOL_SIZE'] = int(os.getenv('CHATPDF_ASYNC_POOL_SIZE', 200))  # Same, for the ASGI server
+app.config['CHATPDF_CONNECT_TIMEOUT'] = float(os.getenv('CHATPDF_CONNECT_TIMEOUT', 5))
+app.config['CHATPDF_READ_TIMEOUT'] = float(os.getenv('CHATPDF_READ_TIMEOUT', 120))
+
+# Idempotent upstream calls are retried with jittered exponential backoff, honoring Retry-After
+app.config['UPSTREAM_RETRIES'] = int(os.getenv('UPSTREAM_RETRIES', 2))
+app.config['UPSTREAM_RETRY_BASE_DELAY'] = float(os.getenv('UPSTREAM_RETRY_BASE_DELAY', 0.5))
+app.config['UPSTREAM_RETRY_MAX_DELAY'] = float(os.getenv('UPSTREAM_RETRY_MAX_DELAY', 5))
+app.config['UPSTREAM_MAX_RETRY_AFTER'] = float(os.getenv('UPSTREAM_MAX_RETRY_AFTER', 10))  # Longer waits give up
+upstream_retry = RetryPolicy(
+    app.config['UPSTREAM_RETRIES'],
+    app.config['UPSTREAM_RETRY_BASE_DELAY'],
+    app.config['UPSTREAM_RETRY_MAX_DELAY'],
+    app.config['UPSTREAM_MAX_RETRY_AFTER'],
+)
+
+# Once this share of upstream calls fails, every call fails fast until a probe succeeds
+app.config['CIRCUIT_FAILURE_RATE'] = float(os.getenv('CIRCUIT_FAILURE_RATE', 0.5))
+app.config['CIRCUIT_MIN_CALLS'] = int(os.getenv('CIRCUIT_MIN_CALLS', 10))  # Within the window, before it can open
+app.config['CIRCUIT_WINDOW'] = float(os.getenv('CIRCUIT_WINDOW', 30))  # Seconds of outcomes considered
+app.config['CIRCUIT_OPEN_SECONDS'] = float(os.getenv('CIRCUIT_OPEN_SECONDS', 30))  # Before probing again
+upstream_breaker = CircuitBreaker(
+    app.config['CIRCUIT_FAILURE_RATE'],
+    app.config['CIRCUIT_MIN_CALLS'],
+    app.config['CIRCUIT_WINDOW'],
+    app.config['CIRCUIT_OPEN_SECONDS'],
+)
 
 # Initialize Flask-Caching
 cache = Cache(app, config={'CACHE_TYPE': 'simple'})
 
+# Index of uploaded PDFs by content hash, so repeat uploads skip the upstream call
+app.config['SOURCE_INDEX_PATH'] = os.path.join(app.instance_path, 'source_index.db')
+source_index = SourceIndex(app.config['SOURCE_INDEX_PATH'])
+
+# Store used to coordinate workers (sqlite or memcached)
+app.config['SHARED_STORE_BACKEND'] = os.getenv('SHARED_STORE_BACKEND', 'memcached' if os.getenv('MEMCACHEDCLOUD_SERVERS') else 'sqlite')
+app.config['SHARED_STORE_PATH'] = os.path.join(app.instance_path, 'shared_store.db')
+shared_store = create_shared_store(app.config['SHARED_STORE_BACKEND'], app.config['SHARED_STORE_PATH'])
+
+api_keys = KeyPool(
+    app.config['CHATPDF_API_KEYS'] or [''],
+    source_index,  # Which key created a source is kept as long as the source itself
+    app.config['CHATPDF_KEY_EJECT_SECONDS'],
+)
+base_urls = BaseUrls(
+    [app.config['CHATPDF_BASE_URL']] + app.config['CHATPDF_FALLBACK_BASE_URLS'],
+    app.config['CHATPDF_KEY_EJECT_SECONDS'],
+)
+
+# Client-side ChatPDF quota per API key, shared by all workers through the shared store:
+# requests per minute for ingest (add-file, add-url) and chat, 0 for no limit. Calls queue
+# for a token for up to CHATPDF_RATE_LIMIT_MAX_WAIT seconds and fail after that.
+app.config['CHATPDF_INGEST_RATE_LIMIT'] = float(os.getenv('CHATPDF_INGEST_RATE_LIMIT', 0))
+app.config['CHATPDF_CHAT_RATE_LIMIT'] = float(os.getenv('CHATPDF_CHAT_RATE_LIMIT', 0))
+app.config['CHATPDF_RATE_LIMIT_BURST'] = float(os.getenv('CHATPDF_RATE_LIMIT_BURST', 5))
+app.config['CHATPDF_RATE_LIMIT_MAX_WAIT'] = float(os.getenv('CHATPDF_RATE_LIMIT_MAX_WAIT', 20))
+upstream_buckets = {
+    (name, key.id): TokenBucket(
+        shared_store,
+        f"{name}:{key.id}",
+        app.config[setting],
+        app.config['CHATPDF_RATE_LIMIT_BURST'],
+        app.config['CHATPDF_RATE_LIMIT_MAX_WAIT'],
+    )
+    for name, setting in (('ingest', 'CHATPDF_INGEST_RATE_LIMIT'), ('chat', 'CHATPDF_CHAT_RATE_LIMIT'))
+    for key in api_keys.keys
+    if app.config[setting] > 0
+}
+
+# Identical upstream calls in flight at the same time share one request; set
+# SINGLEFLIGHT_SHARED=true to also coalesce across workers through the shared store
+app.config['SINGLEFLIGHT_SHARED'] = os.getenv('SINGLEFLIGHT_SHARED', 'false').lower() == 'true'
+singleflight = SingleFlight(
+    shared_store if app.config['SINGLEFLIGHT_SHARED'] else None,
+    wait_timeout=(app.config['CHATPDF_CONNECT_TIMEOUT'] + app.config['CHATPDF_READ_TIMEOUT'])
+    * (app.config['UPSTREAM_RETRIES'] + 1),
+    time_left=deadlines.time_left,
+)
+
+# Chat forms carry a one-time request token. A resubmitted form (refresh, back button,
+# double click) gets the answer of its first submission instead of a new upstream call,
+# for CHAT_REQUEST_TTL seconds.
+app.config['CHAT_REQUEST_TTL'] = int(os.getenv('CHAT_REQUEST_TTL', 60 * 60))
+
+# Background upload jobs, used when the browser sends "Prefer: respond-async"
+app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 4))  # Threads per worker process
+app.config['JOB_QUEUE_SIZE'] = int(os.getenv('JOB_QUEUE_SIZE', 100))
+app.config['JOB_TTL'] = int(os.getenv('JOB_TTL', 60 * 60))  # How long job status can be polled
+upload_jobs = JobQueue(
+    shared_store,
+    app.config['JOB_WORKERS'],
+    app.config['JOB_QUEUE_SIZE'],
+    app.config['JOB_TTL'],
+    context=app.app_context,
+)
+
+# Shared by all batch uploads in this worker, so concurrent batches cannot multiply the load
+batch_executor = ThreadPoolExecutor(app.config['BATCH_CONCURRENCY'], thread_name_prefix='batch')
+
+# Bulkheads: uploads and chat turns get separate concurrency limits per worker process, so
+# slow ingests cannot take every thread and connection from chat. A request waits up to
+# *_QUEUE_TIMEOUT seconds in a queue of at most *_QUEUE_SIZE for a slot, and gets a 503
+# with Retry-After otherwise. Background upload jobs take ingest slots too.
+app.config['INGEST_CONCURRENCY'] = int(os.getenv('INGEST_CONCURRENCY', 4))
+app.config['INGEST_QUEUE_SIZE'] = int(os.getenv('INGEST_QUEUE_SIZE', 8))
+app.config['INGEST_QUEUE_TIMEOUT'] = float(os.getenv('INGEST_QUEUE_TIMEOUT', 5))
+app.config['CHAT_CONCURRENCY'] = int(os.getenv('CHAT_CONCURRENCY', app.config['CHATPDF_POOL_SIZE']))
+app.config['CHAT_QUEUE_SIZE'] = int(os.getenv('CHAT_QUEUE_SIZE', 20))
+app.config['CHAT_QUEUE_TIMEOUT'] = float(os.getenv('CHAT_QUEUE_TIMEOUT', 2))
+ingest_bulkhead = Bulkhead(
+    'ingest', app.config['INGEST_CONCURRENCY'], app.config['INGEST_QUEUE_SIZE'], app.config['INGEST_QUEUE_TIMEOUT'],
+)
+chat_bulkhead = Bulkhead(
+    'chat', app.config['CHAT_CONCURRENCY'], app.config['CHAT_QUEUE_SIZE'], app.config['CHAT_QUEUE_TIMEOUT'],
+)
+# The ASGI server holds no thread per request, so its limits follow the size of its
+# upstream connection pool instead (see asgi.py); queue sizes and timeouts are shared
+app.config['ASYNC_INGEST_CONCURRENCY'] = int(
+    os.getenv('ASYNC_INGEST_CONCURRENCY', max(1, app.config['CHATPDF_ASYNC_POOL_SIZE'] // 4))
+)
+app.config['ASYNC_CHAT_CONCURRENCY'] = int(
+    os.getenv('ASYNC_CHAT_CONCURRENCY', app.config['CHATPDF_ASYNC_POOL_SIZE'])
+)
+
+# Admission control in front of every route but the exempt paths: a per-process concurrency
+# limit that backs off while requests queue longer than ADMISSION_TARGET_DELAY before a
+# worker picks them up. Queueing delay is read from the timestamp a proxy puts in
+# ADMISSION_DELAY_HEADER (Heroku's router does; nginx can with "t=${msec}"); without it only
+# the static limit and the per-client share apply.
+app.config['ADMISSION_ENABLED'] = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+app.config['ADMISSION_TARGET_DELAY'] = float(os.getenv('ADMISSION_TARGET_DELAY', 0.1))  # Seconds
+app.config['ADMISSION_INTERVAL'] = float(os.getenv('ADMISSION_INTERVAL', 1))  # Seconds between limit changes
+app.config['ADMISSION_MIN_LIMIT'] = int(os.getenv('ADMISSION_MIN_LIMIT', 4))
+app.config['ADMISSION_MAX_LIMIT'] = int(os.getenv('ADMISSION_MAX_LIMIT', 100))
+# The ASGI server holds many more requests per process; by default its limit admits
+# everything its bulkheads can run and queue
+app.config['ASYNC_ADMISSION_MAX_LIMIT'] = int(os.getenv(
+    'ASYNC_ADMISSION_MAX_LIMIT',
+    app.config['ASYNC_INGEST_CONCURRENCY'] + app.config['INGEST_QUEUE_SIZE']
+    + app.config['ASYNC_CHAT_CONCURRENCY'] + app.config['CHAT_QUEUE_SIZE'],
+))
+app.config['ADMISSION_CLIENT_SHARE'] = float(os.getenv('ADMISSION_CLIENT_SHARE', 0.5))  # Of the limit; 0 disables
+app.config['ADMISSION_DELAY_HEADER'] = os.getenv('ADMISSION_DELAY_HEADER', 'X-Request-Start')
+app.config['ADMISSION_EXEMPT_PATHS'] = os.getenv('ADMISSION_EXEMPT_PATHS', '/healthz,/metrics,/static/').split(',')
+admission = AdmissionMiddleware(
+    app.wsgi_app,
+    AdmissionController(
+        app.config['ADMISSION_TARGET_DELAY'],
+        app.config['ADMISSION_INTERVAL'],
+        app.config['ADMISSION_MIN_LIMIT'],
+        app.config['ADMISSION_MAX_LIMIT'],
+        client_share=app.config['ADMISSION_CLIENT_SHARE'],
+    ),
+    app.config['ADMISSION_EXEMPT_PATHS'],
+    app.config['ADMISSION_DELAY_HEADER'],
+    on_reject=lambda reason: metrics.ADMISSION_REJECTIONS.labels(reason).inc(),
+)
+if app.config['ADMISSION_ENABLED']:
+    app.wsgi_app = admission
+
+# Hedged chat calls: when an answer takes longer than CHAT_HEDGE_PERCENTILE of recent calls,
+# the same question is sent again and the first answer wins. CHAT_HEDGE_BUDGET caps the
+# extra requests as a share of chat calls.
+app.config['CHAT_HEDGE_ENABLED'] = os.getenv('CHAT_HEDGE_ENABLED', 'false').lower() == 'true'
+app.config['CHAT_HEDGE_PERCENTILE'] = float(os.getenv('CHAT_HEDGE_PERCENTILE', 0.95))
+app.config['CHAT_HEDGE_BUDGET'] = float(os.getenv('CHAT_HEDGE_BUDGET', 0.05))
+app.config['CHAT_HEDGE_MIN_DELAY'] = float(os.getenv('CHAT_HEDGE_MIN_DELAY', 1))  # Seconds
+chat_hedger = Hedger(
+    # Each hedged chat holds up to two of these threads
+    ThreadPoolExecutor(app.config['CHAT_CONCURRENCY'] * 2, thread_name_prefix='hedge'),
+    app.config['CHAT_HEDGE_PERCENTILE'],
+    app.config['CHAT_HEDGE_BUDGET'],
+    app.config['CHAT_HEDGE_MIN_DELAY'],
+)
+
+# Configure the conversation store (memory, sqlite or memcached)
+app.config['HISTORY_BACKEND'] = os.getenv('HISTORY_BACKEND', 'memcached' if os.getenv('MEMCACHEDCLOUD_SERVERS') else 'sqlite')
+app.config['HISTORY_PATH'] = os.path.join(app.instance_path, 'history.db')
+app.config['HISTORY_MAX_MESSAGES'] = int(os.getenv('HISTORY_MAX_MESSAGES', 200))  # Per conversation
+app.config['HISTORY_MAX_CONVERSATIONS'] = int(os.getenv('HISTORY_MAX_CONVERSATIONS', 10000))
+app.config['HISTORY_TTL'] = int(os.getenv('HISTORY_TTL', 7 * 24 * 60 * 60))  # Seconds since last use
+
+chat_history = create_history_store(
+    app.config['HISTORY_BACKEND'],
+    app.config['HISTORY_PATH'],
+    app.config['HISTORY_MAX_MESSAGES'],
+    app.config['HISTORY_MAX_CONVERSATIONS'],
+    app.config['HISTORY_TTL'],
+)
+
+# Cache answers to repeat questions about the same document
+app.config['ANSWER_CACHE_ENABLED'] = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+app.config['ANSWER_CACHE_SIZE'] = int(os.getenv('ANSWER_CACHE_SIZE', 5000))
+app.config['ANSWER_CACHE_TTL'] = int(os.getenv('ANSWER_CACHE_TTL', 60 * 60))
+# Cosine similarity above which a paraphrased question reuses an earlier answer; 0 disables matching
+app.config['SIMILAR_QUESTION_THRESHOLD'] = float(os.getenv('SIMILAR_QUESTION_THRESHOLD', 0.9))
+app.config['SIMILAR_QUESTION_LIMIT'] = int(os.getenv('SIMILAR_QUESTION_LIMIT', 128))  # Indexed questions per source
+
+answer_cache = AnswerCache(
+    app.config['ANSWER_CACHE_SIZE'],
+    app.config['ANSWER_CACHE_TTL'],
+    SimilarQuestionIndex(
+        app.config['SIMILAR_QUESTION_THRESHOLD'],
+        max_questions=app.config['SIMILAR_QUESTION_LIMIT'],
+    ) if app.config['SIMILAR_QUESTION_THRESHOLD'] > 0 else None,
+    on_lookup=lambda result: metrics.CACHE_LOOKUPS.labels('answers', result).inc(),
+)
+
+
+class UpstreamPoolTimeout(requests.exceptions.RequestException):
+    # No pooled connection came free in time; this says nothing about ChatPDF itself
+    pass
+
+
+def bounded_wait_pool(pool_class):
+    # requests never passes urllib3 a pool_timeout, so a call would wait for a free pooled
+    # connection forever; it waits no longer than its connect timeout, which is already
+    # clamped to the request's deadline
+    class BoundedWaitPool(pool_class):
+        def urlopen(self, method, url, *args, pool_timeout=None, **kwargs):
+            timeout = kwargs.get('timeout')
+            if pool_timeout is None and isinstance(timeout, Timeout) and isinstance(timeout.connect_timeout, float):
+                pool_timeout = timeout.connect_timeout
+            return super().urlopen(method, url, *args, pool_timeout=pool_timeout, **kwargs)
+
+        def _make_request(self, conn, method, url, *args, timeout=None, **kwargs):
+            # The wait for the connection comes out of what is left of the deadline
+            if isinstance(timeout, Timeout) and deadlines.time_left() is not None:
+                timeout = Timeout(
+                    connect=deadlines.clamp(timeout.connect_timeout), read=deadlines.clamp(timeout.read_timeout),
+                )
+            return super()._make_request(conn, method, url, *args, timeout=timeout, **kwargs)
+
+    return BoundedWaitPool
+
+
+upstream_pool_classes = {
+    scheme: bounded_wait_pool(pool_class) for scheme, pool_class in server_timing.timed_pool_classes.items()
+}
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = upstream_pool_classes
+
+    def send(self, request, **kwargs):
+        with metrics.upstream_call(request.path_url.split('?')[0]) as call, server_timing.upstream_phases():
+            try:
+                response = super().send(request, **kwargs)
+            except EmptyPoolError as e:
+                call['status'] = 'pool_timeout'
+                raise UpstreamPoolTimeout(e, request=request)
+            call['status'] = str(response.status_code)
+            return response
+
+
+def create_upstream_session(pool_size):
+    session = requests.Session()
+    adapter = InstrumentedAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Chat and ingest calls get separate pooled keep-alive sessions per worker, each with room for
+# everything that may call upstream at once, so uploads can never leave chat turns waiting
+# for a connection. Ingest calls come from ingest bulkhead slots (upload routes and jobs) and
+# from batch_executor (batch items and ZIP members); a hedged chat turn may hold two.
+app.config['CHATPDF_INGEST_POOL_SIZE'] = int(os.getenv(
+    'CHATPDF_INGEST_POOL_SIZE', app.config['INGEST_CONCURRENCY'] + app.config['BATCH_CONCURRENCY'],
+))
+app.config['CHATPDF_CHAT_POOL_SIZE'] = int(os.getenv(
+    'CHATPDF_CHAT_POOL_SIZE', app.config['CHAT_CONCURRENCY'] * (2 if app.config['CHAT_HEDGE_ENABLED'] else 1),
+))
+upstream_sessions = {
+    'chat': create_upstream_session(app.config['CHATPDF_CHAT_POOL_SIZE']),
+    'ingest': create_upstream_session(app.config['CHATPDF_INGEST_POOL_SIZE']),
+}
+
+
+def upstream_kind(path):
+    # Chat and ingest calls are pooled and rate limited separately
+    return 'chat' if path.endswith('/v1/chats/message') else 'ingest'
+
+
+def upstream_timeout():
+    # Recomputed for every attempt, so no attempt outlives the request's deadline
+    return deadlines.clamp(app.config['CHATPDF_CONNECT_TIMEOUT']), deadlines.clamp(app.config['CHATPDF_READ_TIMEOUT'])
+
+
+def retry_delay(attempt, retry_after=None):
+    # Seconds to wait before retrying, or None when the retries or the deadline are used up
+    delay = upstream_retry.delay(attempt, retry_after)
+    return delay if delay is not None and deadlines.fits(delay) else None
+
+
+class UpstreamUnavailable(requests.exceptions.RequestException):
+    pass
+
+
+def quota_wait(path, key):
+    # Reserves a token from the key's bucket for the path; returns the seconds to wait for
+    # it, or None when the queue is longer than CHATPDF_RATE_LIMIT_MAX_WAIT
+    name = upstream_kind(path)
+    bucket = upstream_buckets.get((name, key.id))
+    if bucket is None:
+        return 0.0
+
+    wait = bucket.reserve()
+    if wait is None:
+        metrics.RATE_LIMITED.labels(name).inc()
+    else:
+        metrics.RATE_LIMIT_WAIT.labels(name).observe(wait)
+    return wait
+
+
+def reject_key(key, response):
+    # Ejects a key ChatPDF refused; returns whether it was refused
+    if response.status_code not in (401, 429):
+        return False
+    app.logger.warning(f"ChatPDF answered {response.status_code} for API key {key.id}, ejecting it")
+    metrics.API_KEY_EJECTIONS.labels(key.id, str(response.status_code)).inc()
+    api_keys.eject(key, retry_after_seconds(response.headers.get('Retry-After')))
+    return True
+
+
+def bind_new_source(path, key, payload):
+    # Sources only exist under the key that created them
+    source_id = payload.get('sourceId') if isinstance(payload, dict) else None
+    if source_id and not path.endswith('/v1/chats/message'):
+        api_keys.bind(source_id, key)
+
+
+def upstream_headers(key, headers=None):
+    headers = dict(headers or {})
+    if key.key:
+        headers['x-api-key'] = key.key
+    return headers
+
+
+def upstream_post(path, idempotent=False, source_id=None, **kwargs):
+    # Only idempotent calls are retried: other bodies may be one-shot streams. Chat calls
+    # pass their sourceId so they go out under the key that created the source.
+    call = metrics.upstream_call_name(path)
+    session = upstream_sessions[upstream_kind(path)]
+    attempt = 0
+
+    while True:
+        key = api_keys.choose(source_id)
+        # Checked before the quota, so an open circuit fails fast without using up a token
+        if not upstream_breaker.allow():
+            metrics.UPSTREAM_SHORT_CIRCUITS.labels(call).inc()
+            raise UpstreamUnavailable(
+                f"ChatPDF is unavailable, try again in {upstream_breaker.retry_in():.0f}s."
+            )
+
+        # Anything but an outcome (the quota, a bad request body, the deadline, a cancelled
+        # hedge) still has to let the next half-open probe through
+        try:
+            wait = quota_wait(path, key)
+            if wait is None:
+                raise UpstreamUnavailable('The ChatPDF request quota is used up, try again in a minute.')
+            if not deadlines.fits(wait):
+                raise deadlines.DeadlineExceeded()
+            time.sleep(wait)
+
+            base_url = base_urls.choose()
+            api_keys.acquire(key)
+            try:
+                response = session.post(base_url + path, **{
+                    **kwargs, 'headers': upstream_headers(key, kwargs.get('headers')), 'timeout': upstream_timeout(),
+                })
+            except UpstreamPoolTimeout:
+                deadlines.time_left()  # Out of time waiting for a connection: the deadline's 504
+                raise
+            except requests.exceptions.RequestException as e:
+                upstream_breaker.record_failure()
+                if isinstance(e, requests.exceptions.ConnectionError):
+                    base_urls.eject(base_url)
+                deadlines.time_left()  # A timeout cut short by the deadline ends the request
+                delay = retry_delay(attempt) if idempotent else None
+                if delay is None:
+                    raise
+            else:
+                if response.status_code >= 500:
+                    upstream_breaker.record_failure()
+                else:
+                    upstream_breaker.record_success()
+
+                if reject_key(key, response) and idempotent and source_id is None and api_keys.healthy():
+                    response.close()
+                    continue  # Fail over to another key straight away
+
+                if response.ok and not kwargs.get('stream'):
+                    try:
+                        bind_new_source(path, key, response.json())
+                    except ValueError:
+                        pass
+
+                if response.status_code not in RETRY_STATUSES or not idempotent:
+                    return response
+                delay = retry_delay(attempt, response.headers.get('Retry-After'))
+                if delay is None:
+                    return response
+                response.close()
+            finally:
+                api_keys.release(key)
+        except BaseException:
+            upstream_breaker.release()
+            raise
+
+        metrics.UPSTREAM_RETRIES.labels(call).inc()
+        app.logger.debug(f"Retrying {path} in {delay:.2f}s (attempt {attempt + 1})")
+        time.sleep(delay)
+        attempt += 1
+
+
+def warm_upstream():
+    # Drop any connections inherited from the master process and open fresh ones,
+    # so the first user request does not pay for DNS, TCP and TLS setup
+    for session in upstream_sessions.values():
+        session.close()
+        try:
+            session.head(app.config['CHATPDF_BASE_URL'], timeout=upstream_timeout())
+        except requests.exceptions.RequestException as e:
+            app.logger.warning(f"Could not warm upstream connection: {str(e)}")
+
+
+# Scraped by Prometheus; values read at scrape time
+metric_gauges = metrics.GaugeCallbacks()
+metric_gauges.add('chatpdf_conversations', 'Conversations in the history store', chat_history.size)
+metric_gauges.add(
+    'chatpdf_admission_limit', 'Admission concurrency limit of the worker serving the scrape',
+    lambda: admission.controller.limit if app.config['ADMISSION_ENABLED'] else None,
+)
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.labels(request.endpoint or 'unmatched').inc()
+
+
+@app.before_request
+def start_deadline():
+    deadlines.start(app.config['REQUEST_DEADLINES'].get(request.endpoint, app.config['REQUEST_DEADLINE']))
+
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    g.response_location = response.location
+    response.headers['Server-Timing'] = server_timing.header_value(time.perf_counter() - g.request_started)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    # Streamed responses tear down once their body is finished, so they are timed in full
+    if 'request_started' not in g:
+        return
+    route = request.endpoint or 'unmatched'
+    metrics.REQUESTS_IN_FLIGHT.labels(route).dec()
+    metrics.REQUEST_LATENCY.labels(route, request.method).observe(time.perf_counter() - g.request_started)
+    metrics.REQUESTS.labels(route, request.method, str(g.get('response_status', 500))).inc()
+
+
+@app.teardown_request
+def log_slow_request(error=None):
+    if 'request_started' not in g:
+        return
+    duration = time.perf_counter() - g.request_started
+    if not 0 < app.config['SLOW_REQUEST_THRESHOLD'] <= duration:
+        return
+    slow_request_log.warning(json.dumps({
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'route': request.endpoint,
+        'method': request.method,
+        'path': request.path,
+        'source_id': request_source_id(),
+        'status': g.get('response_status', 500),
+        'duration_ms': round(duration * 1000, 1),
+        'timings': server_timing.as_dict(),
+    }))
+
+
+def bulkhead_full(bulkhead):
+    metrics.BULKHEAD_REJECTIONS.labels(bulkhead.name).inc()
+    return ServiceUnavailable(
+        'Too many requests in progress. Please try again shortly.', retry_after=bulkhead.retry_after(),
+    )
+
+
+def in_bulkhead(bulkhead, streaming=False):
+    # Runs POST requests in a bulkhead slot. With streaming=True the slot is held until the
+    # response body has been sent; otherwise it is freed when the view returns.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            if not bulkhead.acquire():
+                raise bulkhead_full(bulkhead)
+
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                bulkhead.release()
+                raise
+            if streaming:
+                response.call_on_close(bulkhead.release)
+            else:
+                bulkhead.release()
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def request_source_id():
+    # Chat routes carry the sourceId in the URL; uploads redirect to the new chat
+    source_id = (request.view_args or {}).get('source_id')
+    location = g.get('response_location')
+    if source_id is None and location:
+        try:
+            endpoint, view_args = app.url_map.bind('localhost').match(urlsplit(location).path)
+        except HTTPException:
+            return None
+        source_id = view_args.get('source_id') if endpoint == 'chat' else None
+    return source_id
+
+
+if app.config['PROFILER_TOKEN']:
+    request_profiler = RequestProfiler(app.config['PROFILE_FOLDER'])
+
+    @app.before_request
+    def start_profile():
+        if request.headers.get('X-Profile') != '1' and request.args.get('profile') != '1':
+            return
+        token = request.headers.get('X-Profile-Token', '')
+        if not secrets.compare_digest(token.encode(), app.config['PROFILER_TOKEN'].encode()):
+            app.logger.warning(f"Rejected profiling request for {request.path}: bad token")
+            return
+        g.profile = request_profiler.start()
+        g.profile_requested = True
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            name, summary = request_profiler.stop(profile, request.endpoint or 'unmatched')
+            response.headers['X-Profile-File'] = name
+            response.headers['X-Profile-Summary'] = summary
+        elif g.get('profile_requested'):
+            response.headers['X-Profile-Summary'] = 'skipped; another request is being profiled'
+        return response
+
+    @app.teardown_request
+    def discard_profile(error=None):
+        # Only reached with a running profile when after_request never ran
+        profile = g.pop('profile', None)
+        if profile is not None:
+            request_profiler.stop(profile, request.endpoint or 'unmatched')
+
+
+def time_render_start(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+def time_render_end(sender, template, context, **extra):
+    if 'render_started' in g:
+        server_timing.record('render', time.perf_counter() - g.pop('render_started'))
+
+
+before_render_template.connect(time_render_start, app)
+template_rendered.connect(time_render_end, app)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(metric_gauges), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/healthz')
+def healthz():
+    return 'ok'
+
 
 @app.route('/')
 def index():
@@ -41,71 +719,594 @@ def index():
 
 
 @app.route('/upload', methods=['POST'])
+@in_bulkhead(ingest_bulkhead)
 def upload_file():
-    if 'file' not in request.files:
-        flash('No file selected.', 'error')
-        return redirect(request.url)
+    filename, chunks, claimed_digest, error_message = open_upload()
+
+    if not error_message and filename.lower().endswith('.zip'):
+        # Only the compressed archive is spooled; its members are never written out
+        with tempfile.TemporaryFile() as spooled:
+            for chunk in chunks:
+                spooled.write(chunk)
+            members, error_message = ingest_zip(spooled, deadlines.current())
+        if not error_message:
+            return jsonify(status='done', members=members)
 
-    file = request.files['file']
+    if error_message and wants_job():
+        return jsonify(status='error', error=error_message), 400
 
-    if file.filename == '':
-        flash('Please select a valid file.', 'error')
-        return redirect(request.url)
+    if error_message:
+        flash(error_message, 'error')
+        return redirect(url_for('index'))
 
-    filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
+    if wants_job():
+        # The job outlives this request, so the file has to be spooled first; ingest_file
+        # removes it once the job is done
+        return submit_upload_job(ingest_file, *save_upload(chunks))
 
-    source_id, error_message = add_pdf_via_file(file_path)
+    if app.config['UPLOAD_SPOOL_TO_DISK']:
+        source_id, error_message = ingest_file(*save_upload(chunks))
+    else:
+        source_id, error_message = stream_upload(chunks, claimed_digest)
 
     if error_message:
         flash(error_message, 'error')
         return redirect(url_for('index'))
 
-    chat_history[source_id] = []
+    chat_history.create(source_id)
     flash('File uploaded successfully.', 'success')  # User feedback
     return redirect(url_for('chat', source_id=source_id))
 
 
 @app.route('/upload_url', methods=['POST'])
+@in_bulkhead(ingest_bulkhead)
 def upload_url():
     url = request.form['url']
+
+    if wants_job():
+        return submit_upload_job(add_pdf_via_url, url)
+
     source_id, error_message = add_pdf_via_url(url)
 
     if error_message:
         flash(error_message, 'error')
         return redirect(url_for('index'))
 
-    chat_history[source_id] = []
+    chat_history.create(source_id)
     flash('File uploaded successfully.', 'success')  # User feedback
     return redirect(url_for('chat', source_id=source_id))
 
 
+@app.route('/upload_batch', methods=['POST'])
+@in_bulkhead(ingest_bulkhead)  # Only while the body is read; items are bounded by batch_executor
+def upload_batch():
+    # Accepts any number of "files" parts and a whitespace-separated "urls" field, and
+    # answers with one NDJSON line per document as each ingest finishes
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return jsonify(error='Expected a multipart/form-data upload.'), 400
+
+    reader = MultipartReader(request.stream, boundary, app.config['UPLOAD_CHUNK_SIZE'])
+    finished = []
+    pending = {}
+    seen = set()
+
+    def submit(item, fn, *args):
+        if len(seen) > app.config['BATCH_MAX_ITEMS']:
+            finished.append({**item, 'error': 'Too many documents in one batch.'})
+        else:
+            pending[batch_executor.submit(run_in_app_context, run_upload_job, fn, *args)] = item
+
+    # Files are spooled one at a time as they arrive while earlier ones are already being ingested
+    for name, filename in reader.parts():
+        if name == 'urls' and filename is None:
+            try:
+                urls = reader.read_field(limit=256 * 1024).split()
+            except FieldTooLarge:
+                return jsonify(error='The urls field is too large.'), 400
+            for url in urls:
+                if url not in seen:
+                    seen.add(url)
+                    submit({'url': url}, add_pdf_via_url, url)
+
+        elif name == 'files' and filename:
+            file_path, digest = save_upload(count_upload_bytes(reader.iter_data()))
+            if digest in seen:
+                os.remove(file_path)
+                continue
+            seen.add(digest)
+
+            item = {'file': filename, 'sha256': digest}
+            source_id = source_index.get(digest)
+            if source_id:
+                os.remove(file_path)
+                finished.append({**item, 'source_id': source_id, 'deduplicated': True})
+            else:
+                submit(item, ingest_file, file_path, digest)
+
+    def results():
+        for item in finished:
+            yield json.dumps(item) + '\n'
+
+        for future in as_completed(pending):
+            item = pending[future]
+            try:
+                source_id, error_message = future.result()
+            except Exception:
+                app.logger.exception(f"Batch item {item} failed")
+                source_id, error_message = None, 'Unexpected error while processing the upload.'
+
+            if error_message:
+                yield json.dumps({**item, 'error': error_message}) + '\n'
+            else:
+                yield json.dumps({**item, 'source_id': source_id}) + '\n'
+
+    return Response(results(), mimetype='application/x-ndjson')
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return jsonify(status='error', error='Unknown upload job.'), 404
+
+    if job['status'] == 'done':
+        job['chat_url'] = url_for('chat', source_id=job['source_id'])
+    return jsonify(job)
+
+
 @app.route('/chat/<source_id>', methods=['GET', 'POST'])
+@in_bulkhead(chat_bulkhead)
 def chat(source_id):
-    history = chat_history.get(source_id, [])
-
     if request.method == 'POST':
-        user_message = request.form.get('user_message')
-        chat_response, error_message = send_chat_message(source_id, user_message)
+        user_message = chat_message()
+        if user_message is None:
+            flash(EMPTY_CHAT_MESSAGE, 'error')
+            return redirect(url_for('chat', source_id=source_id), 303)
 
-        if error_message:
-            flash(error_message, 'error')
+        token = chat_request_token()
+        # A form that was already answered only needs the redirect to show it
+        if claim_chat_request(source_id, token) is None:
+            try:
+                chat_response, error_message = answer_chat_message(source_id, user_message, use_answer_cache())
+            except BaseException:
+                release_chat_request(source_id, token)
+                raise
+
+            if error_message:
+                release_chat_request(source_id, token)
+                flash(error_message, 'error')
+            else:
+                timestamp = format_timestamp()
+                chat_history.append(source_id, [
+                    {'role': 'user', 'content': user_message, 'timestamp': timestamp},
+                    {'role': 'assistant', 'content': chat_response, 'timestamp': timestamp},
+                ])
+                complete_chat_request(source_id, token, chat_response, timestamp)
+
+        # Post/Redirect/Get: refreshing the page afterwards does not resubmit the form
+        return redirect(url_for('chat', source_id=source_id), 303)
+
+    history = chat_history.get(source_id)
+    return render_template('chat.html', source_id=source_id, history=history, request_token=secrets.token_urlsafe(16))
+
+
+@app.route('/chat/<source_id>/stream', methods=['POST'])
+@in_bulkhead(chat_bulkhead, streaming=True)
+def chat_stream(source_id):
+    user_message = chat_message()
+    if user_message is None:
+        return Response(EMPTY_CHAT_MESSAGE, 400, mimetype='text/plain')
+    cached = use_answer_cache()
+    token = chat_request_token()
+
+    def events():
+        earlier = claim_chat_request(source_id, token)
+        if earlier is not None:
+            yield sse_event('token', earlier['answer'])
+            yield sse_event('done', earlier['timestamp'])
+            return
+
+        try:
+            yield from answer_events()
+        except BaseException:
+            release_chat_request(source_id, token)
+            raise
+
+    def answer_events():
+        answer = answer_cache.get(source_id, user_message) if cached else None
+
+        if answer is not None:
+            yield sse_event('token', answer)
         else:
-            timestamp = format_timestamp()
-            history.append({'role': 'user', 'content': user_message, 'timestamp': timestamp})
-            history.append({'role': 'assistant', 'content': chat_response, 'timestamp': timestamp})
+            chunks = []
+            try:
+                for chunk in stream_chat_message(source_id, user_message):
+                    chunks.append(chunk)
+                    yield sse_event('token', chunk)
+            except requests.exceptions.RequestException as e:
+                release_chat_request(source_id, token)
+                yield sse_event('error', f"Error sending chat message: {str(e)}")
+                return
+            except deadlines.DeadlineExceeded as e:
+                release_chat_request(source_id, token)
+                yield sse_event('error', e.description)
+                return
+
+            answer = ''.join(chunks)
+            if cached:
+                answer_cache.put(source_id, user_message, answer)
+
+        # Only a complete answer makes it into the conversation
+        timestamp = format_timestamp()
+        chat_history.append(source_id, [
+            {'role': 'user', 'content': user_message, 'timestamp': timestamp},
+            {'role': 'assistant', 'content': answer, 'timestamp': timestamp},
+        ])
+        complete_chat_request(source_id, token, answer, timestamp)
+        yield sse_event('done', timestamp)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=sse_headers)
+
+
+# Keep proxies from buffering the event stream
+sse_headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+EMPTY_CHAT_MESSAGE = 'Please enter a message.'
+
+
+def chat_message():
+    # The posted question, or None when it is missing or blank; checked before the answer
+    # cache and single-flight, which both key on the question
+    user_message = request.form.get('user_message', '')
+    return user_message if user_message.strip() else None
+
+
+def chat_request_token():
+    # The form's one-time token, or None for clients that send none (or a malformed one). It
+    # is bound to the question, so a stale page that sends a new question with a used token
+    # gets it answered instead of a replay of the old one.
+    token = request.form.get('request_token', '')
+    if not (16 <= len(token) <= 64 and token.replace('-', '').replace('_', '').isalnum()):
+        return None
+    question = hashlib.sha256(request.form.get('user_message', '').encode()).hexdigest()[:16]
+    return f"{token}:{question}"
+
+
+def chat_request_key(source_id, token):
+    return f"chat-request:{source_id}:{token}"
+
+
+def check_chat_request(source_id, token):
+    # One attempt at claiming the form's token: 'claimed' when this submission should be
+    # answered (and later completed or released), 'pending' while an earlier submission is
+    # still running, or the stored record of the earlier submission once it is done
+    key = chat_request_key(source_id, token)
+    for _ in range(2):
+        # Pending claims expire after the longest an upstream chat call can take
+        if shared_store.add(key, json.dumps({'status': 'pending'}), singleflight.wait_timeout):
+            return 'claimed'
+        value = shared_store.get(key)
+        if value is not None:
+            break
+        # Released or expired between the two calls, so claiming it again should work
+    else:
+        # A key that can neither be added nor read means the store is down (memcached
+        # answers that way when unreachable); chat must not depend on it, so go ahead
+        app.logger.warning(f"Shared store unavailable, answering chat request {token} without deduplication")
+        return 'claimed'
+    record = json.loads(value)
+    if record['status'] != 'done':
+        return 'pending'
+    metrics.CHAT_REQUEST_REPLAYS.inc()
+    return record
+
+
+def claim_chat_request(source_id, token):
+    # Returns None when this submission should be answered, or the record of an earlier
+    # submission of the same form. A duplicate of a submission that is still running waits
+    # for it, up to the request's deadline.
+    if token is None:
+        return None
+    while True:
+        result = check_chat_request(source_id, token)
+        if result == 'claimed':
+            return None
+        if result != 'pending':
+            return result
+        deadlines.time_left()
+        time.sleep(0.1)
+
+
+def complete_chat_request(source_id, token, answer, timestamp):
+    if token is not None:
+        shared_store.set(
+            chat_request_key(source_id, token),
+            json.dumps({'status': 'done', 'answer': answer, 'timestamp': timestamp}),
+            app.config['CHAT_REQUEST_TTL'],
+        )
+
+
+def release_chat_request(source_id, token):
+    # A failed submission may be sent again
+    if token is not None:
+        shared_store.delete(chat_request_key(source_id, token))
+
+
+def open_upload():
+    # Positions the request body at the uploaded file and returns its name and chunks,
+    # without Werkzeug spooling the body first
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return None, None, None, 'No file selected.'
+
+    reader = MultipartReader(request.stream, boundary, app.config['UPLOAD_CHUNK_SIZE'])
+    claimed_digest = None
+
+    # index.html sends the browser-computed digest ahead of the file, so a known PDF
+    # can be matched before any of its bytes are read
+    for name, filename in reader.parts():
+        if name == 'content_sha256' and filename is None:
+            try:
+                claimed_digest = reader.read_field()
+            except FieldTooLarge:
+                return None, None, None, 'Invalid file checksum.'
+        elif name == 'file' and filename is not None:
+            break
+    else:
+        return None, None, None, 'No file selected.'
+
+    if filename == '':
+        return None, None, None, 'Please select a valid file.'
+
+    chunks = count_upload_bytes(reader.iter_data())
+    if not filename.lower().endswith('.zip'):
+        chunks = limit_size(chunks, app.config['MAX_CONTENT_LENGTH'])
+    return filename, chunks, claimed_digest, None
+
+
+def count_upload_bytes(chunks):
+    counter = metrics.UPLOAD_BYTES.labels(request.endpoint)
+    for chunk in chunks:
+        counter.inc(len(chunk))
+        yield chunk
+
+
+def limit_size(chunks, max_size):
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size > max_size:
+            raise RequestEntityTooLarge()
+        yield chunk
+
+
+def reuse_source(chunks, claimed_digest, source_id):
+    # The client's digest is only a hint: the source is reused once the bytes it actually sent
+    # hash to that digest, so a digest alone never hands out someone else's document
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    if digest.hexdigest() != claimed_digest:
+        return None, 'The uploaded file does not match its checksum. Please try again.'
+    app.logger.debug(f"Reusing source {source_id} for upload {claimed_digest}")
+    return source_id, None
+
+
+def stream_upload(chunks, claimed_digest):
+    source_id = source_index.get(claimed_digest) if claimed_digest else None
+    if source_id:
+        return reuse_source(chunks, claimed_digest, source_id)
+
+    uploaded = False
+
+    def upload():
+        nonlocal uploaded
+        uploaded = True
+        digest = hashlib.sha256()
+
+        def hashed_chunks():
+            for chunk in chunks:
+                digest.update(chunk)
+                yield chunk
+
+        source_id, error_message = add_pdf_via_stream(hashed_chunks())
+        if source_id:
+            # Only digests computed here go into the index
+            source_index.put(digest.hexdigest(), source_id)
+            if claimed_digest and digest.hexdigest() != claimed_digest:
+                # Callers waiting on the claimed digest must not get another file's source
+                return None, 'The uploaded file does not match its checksum. Please try again.'
+        return source_id, error_message
+
+    # Concurrent uploads of the same PDF wait for the first one instead of streaming their own
+    # copy; clients that send no digest cannot be matched before their upload is complete
+    if not claimed_digest:
+        return upload()
+    source_id, error_message = singleflight.do(('add-file', claimed_digest), upload)
+    if uploaded or not source_id:
+        return source_id, error_message
+    return reuse_source(chunks, claimed_digest, source_id)
+
+
+def ingest_zip(spooled, deadline=None):
+    # Members are decompressed chunk by chunk and streamed to ChatPDF in parallel on the batch
+    # pool. With a deadline, members that are not done by then are reported as timed out.
+    try:
+        archive = zipfile.ZipFile(spooled)
+    except zipfile.BadZipFile:
+        return None, 'The uploaded file is not a valid ZIP archive.'
+
+    with archive:
+        members = [
+            member for member in archive.infolist()
+            if not member.is_dir() and member.filename.lower().endswith('.pdf')
+            and not member.filename.startswith('__MACOSX/')
+        ]
+        if not members:
+            return None, 'The ZIP archive does not contain any PDF files.'
+        if sum(member.file_size for member in members) > app.config['ZIP_MAX_TOTAL_SIZE']:
+            return None, 'The ZIP archive is too large once uncompressed.'
+
+        # Declared sizes can lie, so the bytes actually decompressed are counted as well
+        budget = {'remaining': app.config['ZIP_MAX_TOTAL_SIZE']}
+        budget_lock = threading.Lock()
 
-    return render_template('chat.html', source_id=source_id, history=history)
+        def charge(size):
+            with budget_lock:
+                budget['remaining'] -= size
+                if budget['remaining'] < 0:
+                    raise ValueError('The ZIP archive is too large once uncompressed.')
 
+        futures = {
+            member.filename: batch_executor.submit(
+                run_in_app_context, ingest_zip_member, archive, member, charge, deadline,
+            )
+            for member in members
+        }
 
-@cache.memoize(timeout=50)  # Cache API responses for 50 seconds
-def add_pdf_via_file(file_path):
-    headers = {'x-api-key': api_key}
-    files = {'file': ('file', open(file_path, 'rb'), 'application/octet-stream')}
+        results = {}
+        for name, future in futures.items():
+            try:
+                source_id, error_message = future.result(
+                    None if deadline is None else max(0, deadline - time.monotonic())
+                )
+            except (TimeoutError, deadlines.DeadlineExceeded):
+                # Members still queued are dropped; running ones stop at the same deadline
+                future.cancel()
+                source_id, error_message = None, 'Timed out before this file was processed. Please try again.'
+            results[name] = {'error': error_message} if error_message else {'source_id': source_id}
+        return results, None
 
+
+def ingest_zip_member(archive, member, charge, deadline=None):
+    deadlines.resume(deadline)
+    if member.file_size > app.config['ZIP_MAX_MEMBER_SIZE']:
+        return None, 'File is too large.'
+
+    # Hash first so PDFs that were already ingested are never sent again
+    digest = hashlib.sha256()
+    try:
+        for chunk in read_zip_member(archive, member, charge):
+            digest.update(chunk)
+    except (ValueError, zipfile.BadZipFile) as e:
+        return None, f"Error reading file: {str(e)}"
+    digest = digest.hexdigest()
+
+    source_id = source_index.get(digest)
+    if source_id is None:
+        source_id, error_message = singleflight.do(
+            ('add-file', digest), add_pdf_via_stream, read_zip_member(archive, member)
+        )
+        if error_message:
+            return None, error_message
+        source_index.put(digest, source_id)
+
+    chat_history.create(source_id)
+    return source_id, None
+
+
+def read_zip_member(archive, member, charge=None):
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    size = 0
+    with archive.open(member) as stream:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            size += len(chunk)
+            if size > app.config['ZIP_MAX_MEMBER_SIZE']:
+                raise ValueError('File is too large.')
+            if charge is not None:
+                charge(len(chunk))
+            yield chunk
+
+
+def wants_job():
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+def submit_upload_job(fn, *args):
+    job_id = upload_jobs.submit(run_ingest_job, fn, *args)
+    if job_id is None:
+        return jsonify(status='error', error='Too many uploads in progress. Please try again shortly.'), 503, {'Retry-After': '5'}
+    return jsonify(upload_jobs.get(job_id)), 202, {'Location': url_for('job_status', job_id=job_id)}
+
+
+def run_in_app_context(fn, *args):
+    with app.app_context():
+        return fn(*args)
+
+
+def run_ingest_job(fn, *args):
+    # Upload jobs share the ingest bulkhead with the upload routes
+    ingest_bulkhead.acquire(background=True)
     try:
-        response = requests.post('https://api.chatpdf.com/v1/sources/add-file', headers=headers, files=files)
+        return run_upload_job(fn, *args)
+    finally:
+        ingest_bulkhead.release()
+
+
+def run_upload_job(fn, *args):
+    source_id, error_message = fn(*args)
+    if source_id:
+        chat_history.create(source_id)
+    return source_id, error_message
+
+
+def ingest_file(file_path, digest):
+    # Spooled files are removed once ingested, whatever the outcome
+    try:
+        source_id = source_index.get(digest)
+        if source_id:
+            app.logger.debug(f"Reusing source {source_id} for upload {digest}")
+            return source_id, None
+
+        source_id, error_message = add_pdf_via_file(file_path, digest)
+        if source_id:
+            source_index.put(digest, source_id)
+        return source_id, error_message
+    finally:
+        os.remove(file_path)
+
+
+def save_upload(chunks):
+    # Hash the PDF while it is written to disk, then name it by its digest. Each upload keeps
+    # its own file, so removing one never pulls the file from under a concurrent upload.
+    digest = hashlib.sha256()
+    partial_path = os.path.join(app.config['UPLOAD_FOLDER'], f".{secrets.token_hex(8)}.part")
+
+    try:
+        with open(partial_path, 'wb') as out:
+            for chunk in chunks:
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(partial_path)  # e.g. a body over the size limit
+        raise
+
+    digest = digest.hexdigest()
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{digest}-{secrets.token_hex(4)}.pdf")
+    os.replace(partial_path, file_path)
+    return file_path, digest
+
+
+@singleflight.coalesce(lambda file_path, digest: ('add-file', digest))
+def add_pdf_via_file(file_path, digest):
+    with open(file_path, 'rb') as pdf:
+        return add_pdf_source(files={'file': ('file', pdf, 'application/octet-stream')})
+
+
+def add_pdf_via_stream(chunks):
+    body, content_type = multipart_file_body(chunks)
+    return add_pdf_source(data=body, headers={'Content-Type': content_type})
+
+
+def add_pdf_source(**kwargs):
+    try:
+        response = upstream_post('/v1/sources/add-file', **kwargs)
         response.raise_for_status()
         data = response.json()
         source_id = data.get('sourceId')
@@ -115,17 +1316,18 @@ def add_pdf_via_file(file_path):
         error_message = f"Error uploading file: {str(e)}"
         return None, error_message
 
+    except ValueError as e:  # Malformed multipart body from the browser
+        error_message = f"Error uploading file: {str(e)}"
+        return None, error_message
+
 
-@cache.memoize(timeout=50)  # Cache API responses for 50 seconds
+@metrics.track_cache('upload_url', cache.memoize(timeout=50))  # Cache API responses for 50 seconds
+@singleflight.coalesce(lambda url: ('add-url', url))
 def add_pdf_via_url(url):
-    headers = {
-        'x-api-key': api_key,
-        'Content-Type': 'application/json'
-    }
     data = {'url': url}
 
     try:
-        response = requests.post('https://api.chatpdf.com/v1/sources/add-url', headers=headers, json=data)
+        response = upstream_post('/v1/sources/add-url', idempotent=True, json=data)
         response.raise_for_status()
         data = response.json()
         source_id = data['sourceId']
@@ -140,12 +1342,27 @@ def add_pdf_via_url(url):
         return None, error_message
 
 
-def send_chat_message(source_id, user_message):
-    headers = {
-        'x-api-key': api_key,
-        'Content-Type': 'application/json'
-    }
+def use_answer_cache():
+    # A chat form can send no_cache=1 to force a fresh answer
+    return app.config['ANSWER_CACHE_ENABLED'] and request.values.get('no_cache') != '1'
+
+
+def answer_chat_message(source_id, user_message, cached=True):
+    if cached:
+        chat_response = answer_cache.get(source_id, user_message)
+        if chat_response is not None:
+            app.logger.debug(f"Answer cache hit for {source_id}")
+            return chat_response, None
+
+    chat_response, error_message = send_chat_message(source_id, user_message)
 
+    if cached and not error_message:
+        answer_cache.put(source_id, user_message, chat_response)
+    return chat_response, error_message
+
+
+@singleflight.coalesce(lambda source_id, user_message: ('chat', source_id, normalize_question(user_message)))
+def send_chat_message(source_id, user_message):
     timestamp = format_timestamp()
 
     data = {
@@ -156,9 +1373,10 @@ def send_chat_message(source_id, user_message):
     }
 
     try:
-        response = requests.post('https://api.chatpdf.com/v1/chats/message', headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()['content']
+        if app.config['CHAT_HEDGE_ENABLED']:
+            result = chat_hedger.call(request_chat_answer, data, on_hedge=record_hedge)
+        else:
+            result = request_chat_answer(data)
         return result, None
 
     except requests.exceptions.RequestException as e:
@@ -166,10 +1384,39 @@ def send_chat_message(source_id, user_message):
         return None, error_message
 
 
+def request_chat_answer(data):
+    response = upstream_post('/v1/chats/message', idempotent=True, source_id=data['sourceId'], json=data)
+    response.raise_for_status()
+    return response.json()['content']
+
+
+def record_hedge(winner):
+    metrics.CHAT_HEDGES.labels(winner).inc()
+
+
+def stream_chat_message(source_id, user_message):
+    data = {
+        'sourceId': source_id,
+        'stream': True,
+        'messages': [
+            {'role': 'user', 'content': user_message, 'timestamp': format_timestamp()}
+        ]
+    }
+
+    with upstream_post('/v1/chats/message', idempotent=True, source_id=data['sourceId'], json=data, stream=True) as response:
+        response.raise_for_status()
+        response.encoding = response.encoding or 'utf-8'
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+            deadlines.time_left()  # Read timeouts apply per chunk, the deadline to the whole answer
+            if chunk:
+                yield chunk
+
+
 def format_timestamp():
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))  # Use the PORT environment variable if available
+    warm_upstream()
     app.run(debug=False, host='0.0.0.0', port=port)
@@ -0,0 +1,23 @@
+import os
+import threading
+
+_local = threading.local()
+
+
+def memcached_servers():
+    servers = os.getenv('MEMCACHEDCLOUD_SERVERS', '')
+    return [server.strip() for server in servers.split(',') if server.strip()]
+
+
+def get_memcached():
+    # bmemcached clients hold plain sockets and are not thread safe, so keep one per thread
+    client = getattr(_local, 'client', None)
+    if client is None:
+        import bmemcached
+        client = bmemcached.Client(
+            memcached_servers(),
+            os.getenv('MEMCACHEDCLOUD_USERNAME'),
+            os.getenv('MEMCACHEDCLOUD_PASSWORD'),
+        )
+        _local.client = client
+    return client
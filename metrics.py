@@ -0,0 +1,151 @@
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Prometheus metrics. When PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py does this),
+# every worker writes its samples to files in that directory and any worker can serve
+# the sum of all of them on /metrics.
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Upstream calls run up to CHATPDF_READ_TIMEOUT, so the buckets go well past the defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# ChatPDF endpoints, named after the functions that call them
+UPSTREAM_CALLS = {
+    '/v1/sources/add-file': 'add_pdf_via_file',
+    '/v1/sources/add-url': 'add_pdf_via_url',
+    '/v1/chats/message': 'send_chat_message',
+}
+
+REQUEST_LATENCY = Histogram(
+    'chatpdf_request_duration_seconds', 'Time to handle a request, including streamed bodies',
+    ['route', 'method'], buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter('chatpdf_requests_total', 'Requests handled', ['route', 'method', 'status'])
+REQUESTS_IN_FLIGHT = Gauge(
+    'chatpdf_requests_in_flight', 'Requests being handled', ['route'], multiprocess_mode='livesum',
+)
+
+UPSTREAM_LATENCY = Histogram(
+    'chatpdf_upstream_duration_seconds', 'Time until ChatPDF answers with response headers',
+    ['call'], buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_RESPONSES = Counter(
+    'chatpdf_upstream_responses_total',
+    'ChatPDF responses by status; "error" when no response arrived, "cancelled" for dropped hedges',
+    ['call', 'status'],
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    'chatpdf_upstream_in_flight', 'ChatPDF calls waiting for response headers', ['call'], multiprocess_mode='livesum',
+)
+UPSTREAM_RETRIES = Counter('chatpdf_upstream_retries_total', 'ChatPDF calls retried after a failure', ['call'])
+UPSTREAM_SHORT_CIRCUITS = Counter(
+    'chatpdf_upstream_short_circuits_total', 'ChatPDF calls failed fast by the open circuit breaker', ['call'],
+)
+RATE_LIMIT_WAIT = Histogram(
+    'chatpdf_rate_limit_wait_seconds', 'Time ChatPDF calls queued for a quota token', ['bucket'],
+    buckets=(0, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60),
+)
+RATE_LIMITED = Counter('chatpdf_rate_limited_total', 'ChatPDF calls given up for lack of quota', ['bucket'])
+API_KEY_EJECTIONS = Counter(
+    'chatpdf_api_key_ejections_total', 'ChatPDF API keys taken out of rotation by the status that caused it', ['key', 'status'],
+)
+CHAT_HEDGES = Counter('chatpdf_chat_hedges_total', 'Hedged chat calls by the attempt that answered first', ['winner'])
+
+BULKHEAD_REJECTIONS = Counter(
+    'chatpdf_bulkhead_rejections_total', 'Requests answered 503 because their bulkhead was full', ['bulkhead'],
+)
+ADMISSION_REJECTIONS = Counter(
+    'chatpdf_admission_rejections_total',
+    'Requests shed by admission control: "delay" for a standing queue, "limit" or "client" share exceeded',
+    ['reason'],
+)
+CHAT_REQUEST_REPLAYS = Counter(
+    'chatpdf_chat_request_replays_total', 'Resubmitted chat forms answered from their first submission',
+)
+
+UPLOAD_BYTES = Counter('chatpdf_upload_bytes', 'Bytes of uploaded files read from clients', ['route'])
+CACHE_LOOKUPS = Counter('chatpdf_cache_lookups_total', 'Cache lookups by result', ['cache', 'result'])
+
+
+def upstream_call_name(path):
+    for suffix, name in UPSTREAM_CALLS.items():
+        if path.endswith(suffix):
+            return name
+    return 'other'
+
+
+@contextmanager
+def upstream_call(path):
+    # Times one upstream request up to its response headers; the caller sets result['status']
+    call = upstream_call_name(path)
+    result = {'status': 'error'}
+    UPSTREAM_IN_FLIGHT.labels(call).inc()
+    started = time.perf_counter()
+    try:
+        yield result
+    finally:
+        UPSTREAM_IN_FLIGHT.labels(call).dec()
+        UPSTREAM_LATENCY.labels(call).observe(time.perf_counter() - started)
+        UPSTREAM_RESPONSES.labels(call, result['status']).inc()
+
+
+def track_cache(name, memoize):
+    # Applies a Flask-Caching memoize decorator and counts its lookups as hits or misses;
+    # a lookup is a miss when the wrapped function actually runs
+    local = threading.local()
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def miss(*args, **kwargs):
+            local.missed = True
+            return fn(*args, **kwargs)
+
+        cached = memoize(miss)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            local.missed = False
+            try:
+                return cached(*args, **kwargs)
+            finally:
+                CACHE_LOOKUPS.labels(name, 'miss' if local.missed else 'hit').inc()
+
+        return wrapper
+
+    return decorator
+
+
+class GaugeCallbacks:
+    # Gauges read at scrape time, e.g. store sizes; callbacks returning None are skipped
+
+    def __init__(self):
+        self.gauges = []
+
+    def add(self, name, documentation, callback):
+        self.gauges.append((name, documentation, callback))
+
+    def collect(self):
+        for name, documentation, callback in self.gauges:
+            value = callback()
+            if value is not None:
+                yield GaugeMetricFamily(name, documentation, value=value)
+
+
+def render(callbacks):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    scrape = CollectorRegistry()
+    scrape.register(callbacks)
+    return generate_latest(registry) + generate_latest(scrape)
@@ -0,0 +1,191 @@
+import argparse
+import io
+import json
+import os
+import secrets
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+from stub_server import StubConfig, create_server, parse_latency
+
+# Performance budget: microbenchmarks of the app against the local ChatPDF stub, checked
+# against stored baselines. Exits non-zero when any metric exceeds its baseline by more
+# than the margin. Record baselines on the machine that runs the check:
+#   python perf_budget.py --update
+#   python perf_budget.py --margin 0.25
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf_baselines.json')
+RENDER_SIZES = (10, 100, 1000)
+
+
+def start_stub():
+    # Zero upstream latency, so route timings are the app's own overhead
+    config = StubConfig(
+        upload_latency=parse_latency('const:0'),
+        chat_latency=parse_latency('const:0'),
+        token_delay=0,
+        error_rate=0,
+        burst_every=0,
+        burst_length=0,
+        retry_after=1,
+    )
+    server = create_server('127.0.0.1', 0, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_app(stub):
+    # The app reads its configuration at import time
+    os.environ['CHATPDF_BASE_URL'] = f"http://127.0.0.1:{stub.server_address[1]}"
+    os.environ.setdefault('HISTORY_BACKEND', 'memory')
+    import main
+    main.app.logger.setLevel('WARNING')
+    return main
+
+
+def timed(fn, iterations):
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return latencies
+
+
+def check_response(response, expected_status):
+    # Closing the body is what releases the request's admission and bulkhead slots
+    response.close()
+    if response.status_code != expected_status:
+        raise RuntimeError(f"{response.request.path} answered {response.status_code}")
+
+
+def bench_routes(main, iterations):
+    client = main.app.test_client()
+    metrics = {}
+
+    def upload_file():
+        pdf = b'%PDF-1.4\n%' + secrets.token_hex(16).encode()
+        response = client.post('/upload', data={'file': (io.BytesIO(pdf), 'bench.pdf')},
+                               content_type='multipart/form-data')
+        check_response(response, 302)
+        return response.headers['Location'].rsplit('/', 1)[1]
+
+    def upload_url():
+        url = f"https://example.com/bench.pdf?n={secrets.token_hex(8)}"
+        check_response(client.post('/upload_url', data={'url': url}), 302)
+
+    source_id = upload_file()
+
+    def chat():
+        question = f"What does section {secrets.token_hex(4)} say?"
+        form = {'user_message': question, 'request_token': secrets.token_urlsafe(16)}
+        check_response(client.post(f"/chat/{source_id}", data=form), 303)
+
+    for name, fn in (('chat', chat), ('upload_file', upload_file), ('upload_url', upload_url)):
+        fn()  # Warm up
+        latencies = timed(fn, iterations)
+        metrics[f"route.{name}.p50_ms"] = statistics.median(latencies) * 1000
+        metrics[f"route.{name}.p95_ms"] = latencies[int(0.95 * (len(latencies) - 1))] * 1000
+    return metrics
+
+
+def bench_render(main, iterations):
+    metrics = {}
+    for size in RENDER_SIZES:
+        history = [
+            {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"Message {i} " * 20,
+             'timestamp': '2024-01-01 00:00:00'}
+            for i in range(size)
+        ]
+        with main.app.test_request_context('/chat/bench'):
+            latencies = timed(lambda: main.render_template('chat.html', source_id='bench', history=history),
+                              iterations)
+        metrics[f"render.chat_html.{size}_messages_ms"] = statistics.median(latencies) * 1000
+    return metrics
+
+
+def bench_history_memory(main, conversations):
+    # Bytes retained per conversation filled to the per-conversation cap, with twice the
+    # cap appended so an uncapped store shows up as a regression
+    from history_store import MemoryHistoryStore
+
+    max_messages = main.app.config['HISTORY_MAX_MESSAGES']
+    store = MemoryHistoryStore(max_messages, conversations, main.app.config['HISTORY_TTL'])
+    message = {'role': 'user', 'content': 'What is this document about? ' * 4, 'timestamp': '2024-01-01 00:00:00'}
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for n in range(conversations):
+        source_id = f"src_{n}"
+        store.create(source_id)
+        for _ in range(max_messages):
+            store.append(source_id, [dict(message), dict(message)])
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    return {'memory.history.per_conversation_kb': retained / conversations / 1024}
+
+
+def compare(metrics, baselines, margin, slack):
+    failures = []
+    for name, value in sorted(metrics.items()):
+        baseline = baselines.get(name)
+        if baseline is None:
+            status = 'no baseline'
+        elif value > baseline * (1 + margin) + slack:
+            status = f"FAIL (baseline {baseline:.2f})"
+            failures.append(name)
+        else:
+            status = f"ok (baseline {baseline:.2f})"
+        print(f"{name:<45}{value:>12.2f}  {status}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the app against its performance budget')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--margin', type=float, default=float(os.getenv('PERF_BUDGET_MARGIN', 0.5)),
+                        help='allowed fraction over baseline (default 0.5)')
+    parser.add_argument('--slack', type=float, default=1.0,
+                        help='absolute allowance in ms or KB on top of the margin, for sub-millisecond metrics')
+    parser.add_argument('--baselines', default=BASELINES_PATH)
+    parser.add_argument('--update', action='store_true', help='store this run as the new baselines')
+    args = parser.parse_args()
+
+    stub = start_stub()
+    try:
+        app_module = load_app(stub)
+        metrics = {}
+        metrics.update(bench_routes(app_module, args.iterations))
+        metrics.update(bench_render(app_module, args.iterations))
+        metrics.update(bench_history_memory(app_module, args.conversations))
+    finally:
+        stub.shutdown()
+
+    if args.update:
+        with open(args.baselines, 'w') as f:
+            json.dump({name: round(value, 3) for name, value in sorted(metrics.items())}, f, indent=2)
+            f.write('\n')
+        print(f"Baselines written to {args.baselines}")
+        return 0
+
+    try:
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    failures = compare(metrics, baselines, args.margin, args.slack)
+    if failures:
+        print(f"{len(failures)} metric(s) over budget by more than {args.margin:.0%}: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+import json
+import math
+import time
+
+
+class TokenBucket:
+    # Token bucket kept in the shared store, so every worker (and, with memcached, every
+    # instance) draws from the same upstream quota. Callers reserve a token up front and
+    # the balance may go negative: the deficit tells each caller how long to wait for its
+    # turn, so waiting callers are served in order without polling the store.
+
+    key_prefix = 'bucket:'
+
+    def __init__(self, store, name, per_minute, burst, max_wait, attempts=2):
+        self.store = store
+        self.key = self.key_prefix + name
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_wait = max_wait
+        self.attempts = attempts
+
+    def _take(self, value):
+        now = time.time()
+        state = json.loads(value) if value else {'tokens': self.burst, 'updated': now}
+        tokens = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+
+        wait = max(0.0, (1 - tokens) / self.rate)
+        if wait > self.max_wait:
+            return json.dumps({'tokens': tokens, 'updated': now}), math.inf
+        return json.dumps({'tokens': tokens - 1, 'updated': now}), wait
+
+    def reserve(self):
+        # Seconds to wait before the call may go out, or None when the queue is longer
+        # than max_wait. A bucket that cannot be updated (the store is down, or other callers
+        # kept winning the compare-and-swap) lets the call go: ChatPDF's own 429s still apply.
+        ttl = (self.burst + self.max_wait * self.rate) / self.rate + 60
+        for _ in range(self.attempts):
+            wait = self.store.update(self.key, self._take, ttl)
+            if wait is not None:
+                return None if wait == math.inf else wait
+        return 0.0
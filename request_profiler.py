@@ -0,0 +1,48 @@
+import cProfile
+import os
+import pstats
+import secrets
+import threading
+import time
+
+
+class RequestProfiler:
+    # Profiles single requests with cProfile and saves each profile as a pstats file.
+    # One request per process is profiled at a time, since cProfile can only watch one
+    # thread's calls per profiler and overlapping profiles would be meaningless.
+
+    def __init__(self, directory, top=5):
+        self.directory = directory
+        self.top = top
+        self._busy = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        # Returns a running profile, or None when another request is already being profiled
+        if not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.started = time.perf_counter()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, label):
+        # Saves the profile and returns its file name and a one-line summary
+        try:
+            profile.disable()
+            elapsed = time.perf_counter() - profile.started
+        finally:
+            self._busy.release()
+
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{secrets.token_hex(4)}.prof"
+        profile.dump_stats(os.path.join(self.directory, name))
+
+        stats = pstats.Stats(profile)
+        # Functions with the most time spent in their own code
+        hottest = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]
+        top = ', '.join(
+            f"{os.path.basename(filename)}:{line}({function}) {timings[2] * 1000:.1f}ms"
+            for (filename, line, function), timings in hottest
+        )
+        summary = f"wall={elapsed * 1000:.1f}ms; calls={stats.total_calls}; top={top}"
+        return name, summary
@@ -0,0 +1,120 @@
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+# Responses worth another attempt: rate limiting and gateway-level failures
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+def retry_after_seconds(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    # Jittered exponential backoff ("full jitter"): attempt n sleeps a random time up to
+    # base * 2**n, capped. A Retry-After header overrides the backoff, and one longer
+    # than max_retry_after ends the retries instead.
+
+    def __init__(self, retries, base_delay, max_delay, max_retry_after):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def delay(self, attempt, retry_after=None):
+        # Seconds to wait before the next attempt, or None to give up
+        if attempt >= self.retries:
+            return None
+        wait = retry_after_seconds(retry_after)
+        if wait is None:
+            return self.backoff(attempt)
+        return wait if wait <= self.max_retry_after else None
+
+
+class CircuitBreaker:
+    # Opens when at least min_calls calls finished within the last `window` seconds and
+    # the share of failures among them reached failure_rate. While open every call fails
+    # fast; after open_seconds one probe call at a time is let through (half-open), and
+    # its outcome closes or re-opens the circuit.
+
+    def __init__(self, failure_rate, min_calls, window, open_seconds):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self._opened_at = 0.0
+        self._probing = False
+        self._outcomes = deque()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.open_seconds:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_in(self):
+        # Seconds until the circuit will let a probe through
+        with self._lock:
+            return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def release(self):
+        # For calls that ended without an outcome, e.g. a bad request body, a passed deadline
+        # or a cancelled hedge: they say nothing about the upstream, but a probe among them
+        # must still make way for the next one
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+
+    def record_success(self):
+        self._record(True)
+
+    def record_failure(self):
+        self._record(False)
+
+    def _record(self, ok):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+                if ok:
+                    self.state = 'closed'
+                    self._outcomes.clear()
+                else:
+                    self._open(now)
+                return
+            if self.state == 'open':
+                return  # A call that started before the circuit opened
+
+            self._outcomes.append((now, ok))
+            while self._outcomes and now - self._outcomes[0][0] > self.window:
+                self._outcomes.popleft()
+            failures = sum(1 for _, outcome in self._outcomes if not outcome)
+            if len(self._outcomes) >= self.min_calls and failures >= self.failure_rate * len(self._outcomes):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = 'open'
+        self._opened_at = now
+        self._outcomes.clear()
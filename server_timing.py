@@ -0,0 +1,101 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Per-request phase timings, sent back in a Server-Timing header and used by the slow
+# request log. Phases recorded outside a request (background jobs, batch workers) are dropped.
+
+# Connection setup of the upstream call running on this thread
+_phases = threading.local()
+
+
+def record(name, seconds):
+    if not has_request_context():
+        return
+    timings = g.setdefault('server_timing', {})
+    total, count = timings.get(name, (0.0, 0))
+    timings[name] = (total + seconds, count + 1)
+
+
+def timings():
+    return g.get('server_timing', {}) if has_request_context() else {}
+
+
+def header_value(total_seconds):
+    entries = []
+    for name, (seconds, count) in timings().items():
+        entry = f"{name};dur={seconds * 1000:.1f}"
+        if count > 1:
+            entry += f';desc="{count} calls"'
+        entries.append(entry)
+    entries.append(f"total;dur={total_seconds * 1000:.1f}")
+    return ', '.join(entries)
+
+
+def as_dict():
+    # Milliseconds per phase, for log entries
+    return {name: round(seconds * 1000, 1) for name, (seconds, count) in timings().items()}
+
+
+def record_upstream(elapsed, connect=0.0, tls=0.0):
+    # Splits one upstream request into connect (DNS and TCP), TLS and waiting for the
+    # response headers; a reused keep-alive connection only has the wait
+    if connect:
+        record('upstream-connect', connect)
+    if tls:
+        record('upstream-tls', tls)
+    record('upstream-wait', max(0.0, elapsed - connect - tls))
+
+
+@contextmanager
+def upstream_phases():
+    # Times a requests/urllib3 call made through the timed connection pools below
+    _phases.connect = _phases.tls = 0.0
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_upstream(time.perf_counter() - started, _phases.connect, _phases.tls)
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def _new_conn(self):
+        started = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            _phases.connect = getattr(_phases, 'connect', 0.0) + time.perf_counter() - started
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def _new_conn(self):
+        started = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            _phases.connect = getattr(_phases, 'connect', 0.0) + time.perf_counter() - started
+
+    def connect(self):
+        # Everything connect() spends beyond opening the socket is the TLS handshake
+        started = time.perf_counter()
+        connect_before = getattr(_phases, 'connect', 0.0)
+        try:
+            super().connect()
+        finally:
+            socket_time = getattr(_phases, 'connect', 0.0) - connect_before
+            _phases.tls = getattr(_phases, 'tls', 0.0) + time.perf_counter() - started - socket_time
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+timed_pool_classes = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
@@ -0,0 +1,140 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from memcache_client import get_memcached
+
+
+class SQLiteStore:
+    # Expiring key/value pairs in a SQLite file, for coordination between workers on one instance
+
+    def __init__(self, path, sweep_interval=60):
+        self.path = path
+        # Expired entries are only ever read as missing; each process deletes them in bulk at
+        # most once per sweep_interval seconds
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)')
+
+    def _connect(self):
+        # One connection per thread, kept open: closing the last connection to a WAL database
+        # checkpoints it, which costs more than the query. Forked workers open their own.
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def add(self, key, value, ttl):
+        # Store only if the key is missing or expired; returns whether it was stored
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM entries WHERE key = ? AND expires_at <= ?', (key, time.time()))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO entries (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, time.time() + ttl)
+            )
+        return cursor.rowcount == 1
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM entries WHERE key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        conn = self._connect()
+        conn.execute(
+            'INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, value, time.time() + ttl)
+        )
+        if time.monotonic() >= self._next_sweep:
+            self._next_sweep = time.monotonic() + self.sweep_interval
+            conn.execute('DELETE FROM entries WHERE expires_at <= ?', (time.time(),))
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def update(self, key, fn, ttl):
+        # Atomically replaces the value with fn(value)[0] and returns fn(value)[1];
+        # value is None when the key is missing or expired
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT value FROM entries WHERE key = ? AND expires_at > ?', (key, time.time())
+            ).fetchone()
+            value, result = fn(row[0] if row else None)
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, time.time() + ttl)
+            )
+        return result
+
+
+# memcached reads expiration times over 30 days as a Unix timestamp
+MEMCACHED_MAX_RELATIVE_TTL = 30 * 24 * 60 * 60
+
+
+def memcached_expiry(ttl):
+    if ttl > MEMCACHED_MAX_RELATIVE_TTL:
+        return math.ceil(time.time() + ttl)
+    return math.ceil(ttl)
+
+
+class MemcachedStore:
+    # Same interface backed by memcached, for coordination between instances
+
+    def __init__(self, cas_attempts=10):
+        self.cas_attempts = cas_attempts
+
+    def add(self, key, value, ttl):
+        return bool(get_memcached().add(key, value, time=memcached_expiry(ttl)))
+
+    def get(self, key):
+        return get_memcached().get(key)
+
+    def set(self, key, value, ttl):
+        get_memcached().set(key, value, time=memcached_expiry(ttl))
+
+    def delete(self, key):
+        get_memcached().delete(key)
+
+    def update(self, key, fn, ttl):
+        # Compare-and-swap loop; returns None if the key kept changing underneath
+        client = get_memcached()
+        for _ in range(self.cas_attempts):
+            current, cas = client.gets(key)
+            value, result = fn(current)
+            if cas is None:
+                stored = client.add(key, value, time=memcached_expiry(ttl))
+            else:
+                stored = client.cas(key, value, cas, time=memcached_expiry(ttl))
+            if stored:
+                return result
+        return None
+
+
+def create_shared_store(backend, path):
+    if backend == 'sqlite':
+        return SQLiteStore(path)
+    if backend == 'memcached':
+        return MemcachedStore()
+    raise ValueError(f"Unknown shared store backend: {backend}")
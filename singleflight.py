@@ -0,0 +1,132 @@
+import asyncio
+import functools
+import hashlib
+import json
+import secrets
+import threading
+import time
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Collapses concurrent calls with the same key into one: the first caller runs the
+    # function and everyone who arrives while it is running gets the same result.
+    # With a shared store, callers in other workers wait on the same flight too; results
+    # then have to be JSON serializable and come back as tuples.
+
+    def __init__(self, store=None, wait_timeout=120, poll_interval=0.1, result_ttl=30, time_left=None):
+        self.store = store
+        self.wait_timeout = wait_timeout
+        # Callable giving the caller's remaining time (None for no limit); it raises once the
+        # time is up, which is how a waiting caller gives up on the leader
+        self.time_left = time_left
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            timeout = self.time_left() if self.time_left else None
+            while not call.done.wait(timeout):
+                timeout = self.time_left()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self.store is not None:
+                call.result = self._shared_do(key, fn, *args, **kwargs)
+            else:
+                call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _shared_do(self, key, fn, *args, **kwargs):
+        # The flight lock holds the leader's token; the leader publishes its result under that
+        # token, so waiters never pick up the result of an earlier, unrelated flight
+        name = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        lock_key = f"flight:{name}"
+        deadline = time.monotonic() + self.wait_timeout
+
+        while time.monotonic() < deadline:
+            token = secrets.token_hex(8)
+            if self.store.add(lock_key, token, self.wait_timeout):
+                try:
+                    result = fn(*args, **kwargs)
+                    self.store.set(f"flight-result:{name}:{token}", json.dumps(result), self.result_ttl)
+                    return result
+                finally:
+                    self.store.delete(lock_key)
+
+            leader_token = self.store.get(lock_key)
+            while leader_token and time.monotonic() < deadline:
+                value = self.store.get(f"flight-result:{name}:{leader_token}")
+                if value is not None:
+                    return tuple(json.loads(value))
+                if self.store.get(lock_key) != leader_token:
+                    value = self.store.get(f"flight-result:{name}:{leader_token}")
+                    if value is not None:
+                        return tuple(json.loads(value))
+                    break  # The leader gave up without a result; try to lead instead
+                if self.time_left:
+                    self.time_left()
+                time.sleep(self.poll_interval)
+
+        return fn(*args, **kwargs)
+
+    def coalesce(self, key_func):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                return self.do(key_func(*args, **kwargs), fn, *args, **kwargs)
+            return wrapper
+        return decorator
+
+
+class AsyncSingleFlight:
+    # SingleFlight for coroutines on one event loop: the first caller's call runs as a task
+    # and everyone who arrives while it is running awaits the same task. A caller that is
+    # cancelled or runs out of time leaves the task running for the others.
+
+    def __init__(self, time_left=None):
+        self.time_left = time_left
+        self._calls = {}
+
+    def _done(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved here in case every caller gave up on it
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn(*args, **kwargs))
+            task.add_done_callback(functools.partial(self._done, key))
+
+        timeout = self.time_left() if self.time_left else None
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            if not task.done():
+                self.time_left()  # Out of time waiting on the task: the deadline's 504
+            raise
@@ -0,0 +1,61 @@
+import sqlite3
+import time
+
+
+class SourceIndex:
+    # Persistent SHA-256 -> ChatPDF sourceId map, shared by all workers through one SQLite file.
+    # It also records which API key created each source, for as long as the source is indexed.
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS sources ('
+                'sha256 TEXT PRIMARY KEY, source_id TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS source_keys ('
+                'source_id TEXT PRIMARY KEY, key_id TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, digest):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT source_id FROM sources WHERE sha256 = ?', (digest,)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def put(self, digest, source_id):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO sources (sha256, source_id, created_at) VALUES (?, ?, ?)',
+                    (digest, source_id, time.time())
+                )
+        finally:
+            conn.close()
+
+    def get_key(self, source_id):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT key_id FROM source_keys WHERE source_id = ?', (source_id,)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def put_key(self, source_id, key_id):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO source_keys (source_id, key_id, created_at) VALUES (?, ?, ?)',
+                    (source_id, key_id, time.time())
+                )
+        finally:
+            conn.close()
@@ -0,0 +1,160 @@
+import secrets
+
+from werkzeug.exceptions import ClientDisconnected, RequestEntityTooLarge
+from werkzeug.sansio.multipart import Epilogue, Field, File, MultipartDecoder, NeedData
+
+
+class FieldTooLarge(ValueError):
+    # A plain form field longer than read_field's limit; the rest of the body is left unread
+    pass
+
+
+class MultipartReader:
+    # Pulls multipart/form-data parts off the raw request stream one chunk at a time,
+    # so a file part can be forwarded without Werkzeug spooling it first
+
+    def __init__(self, stream, boundary, chunk_size=64 * 1024):
+        self._stream = stream
+        self._decoder = MultipartDecoder(boundary.encode())
+        self._chunk_size = chunk_size
+        self._in_part = False
+
+    def _next_event(self):
+        while True:
+            event = self._decoder.next_event()
+            if not isinstance(event, NeedData):
+                return event
+            chunk = self._stream.read(self._chunk_size)
+            self._decoder.receive_data(chunk or None)
+
+    def parts(self):
+        # Yields (name, filename) per part; filename is None for plain form fields
+        while True:
+            if self._in_part:
+                for _ in self.iter_data():
+                    pass
+
+            event = self._next_event()
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, File):
+                self._in_part = True
+                yield event.name, event.filename
+            elif isinstance(event, Field):
+                self._in_part = True
+                yield event.name, None
+
+    def iter_data(self):
+        while self._in_part:
+            event = self._next_event()
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                self._in_part = False
+
+    def read_field(self, limit=1024):
+        value = b''
+        for chunk in self.iter_data():
+            value += chunk
+            if len(value) > limit:
+                raise FieldTooLarge(f'Form field is larger than {limit} bytes')
+        return value.decode('utf-8', 'replace')
+
+
+class AsyncMultipartReader:
+    # Same as MultipartReader, but pulls the body from an ASGI receive channel
+
+    def __init__(self, receive, boundary, max_size=None):
+        self._receive = receive
+        self._decoder = MultipartDecoder(boundary.encode())
+        self._max_size = max_size
+        self._received = 0
+        self._more_body = True
+        self._in_part = False
+
+    async def _next_event(self):
+        while True:
+            event = self._decoder.next_event()
+            if not isinstance(event, NeedData):
+                return event
+
+            chunk = b''
+            if self._more_body:
+                message = await self._receive()
+                if message['type'] == 'http.disconnect':
+                    raise ClientDisconnected()
+                chunk = message.get('body', b'')
+                self._more_body = message.get('more_body', False)
+                self._received += len(chunk)
+                if self._max_size is not None and self._received > self._max_size:
+                    raise RequestEntityTooLarge()
+                if not chunk and self._more_body:
+                    continue
+            self._decoder.receive_data(chunk or None)
+
+    async def parts(self):
+        while True:
+            if self._in_part:
+                async for _ in self.iter_data():
+                    pass
+
+            event = await self._next_event()
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, File):
+                self._in_part = True
+                yield event.name, event.filename
+            elif isinstance(event, Field):
+                self._in_part = True
+                yield event.name, None
+
+    async def iter_data(self):
+        while self._in_part:
+            event = await self._next_event()
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                self._in_part = False
+
+    async def read_field(self, limit=1024):
+        value = b''
+        async for chunk in self.iter_data():
+            value += chunk
+            if len(value) > limit:
+                raise FieldTooLarge(f'Form field is larger than {limit} bytes')
+        return value.decode('utf-8', 'replace')
+
+
+def multipart_envelope(field_name, filename, content_type):
+    boundary = secrets.token_hex(16)
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    ).encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    return head, tail, f'multipart/form-data; boundary={boundary}'
+
+
+def multipart_file_body(chunks, field_name='file', filename='file', content_type='application/octet-stream'):
+    # Wrap a stream of file chunks in a single-part multipart body, sent with chunked encoding
+    head, tail, body_type = multipart_envelope(field_name, filename, content_type)
+
+    def body():
+        yield head
+        yield from chunks
+        yield tail
+
+    return body(), body_type
+
+
+def async_multipart_file_body(chunks, field_name='file', filename='file', content_type='application/octet-stream'):
+    head, tail, body_type = multipart_envelope(field_name, filename, content_type)
+
+    async def body():
+        yield head
+        async for chunk in chunks:
+            yield chunk
+        yield tail
+
+    return body(), body_type
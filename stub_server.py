@@ -0,0 +1,184 @@
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the ChatPDF API, for benchmarks and load tests. Point the app at it with
+#   python stub_server.py --port 8765 --latency lognormal:0.4:0.5 --error-rate 0.01
+#   CHATPDF_BASE_URL=http://127.0.0.1:8765 gunicorn main:app
+
+
+def parse_latency(spec):
+    # const:S, uniform:LOW:HIGH, normal:MEAN:STDDEV or lognormal:MEDIAN:SIGMA, all in seconds
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(':')] if params else []
+
+    if kind == 'const' and len(values) == 1:
+        return lambda: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(*values)
+    if kind == 'normal' and len(values) == 2:
+        return lambda: max(0.0, random.gauss(*values))
+    if kind == 'lognormal' and len(values) == 2:
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise argparse.ArgumentTypeError(f"Invalid latency distribution: {spec}")
+
+
+class StubConfig:
+    def __init__(self, upload_latency, chat_latency, token_delay, error_rate,
+                 burst_every, burst_length, retry_after):
+        self.upload_latency = upload_latency
+        self.chat_latency = chat_latency
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.retry_after = retry_after
+        self.started = time.monotonic()
+        self.sources = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def next_source_id(self, body):
+        with self.lock:
+            number = next(self.sources)
+        return f"src_{number}_{hashlib.sha256(body).hexdigest()[:8]}"
+
+    def in_burst(self):
+        # 429s arrive in bursts of burst_length seconds every burst_every seconds
+        if not self.burst_every:
+            return False
+        return (time.monotonic() - self.started) % self.burst_every < self.burst_length
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body go out in separate writes
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        # warm_upstream opens its connection with a HEAD request
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.read_body()
+        config = self.config
+
+        if self.path in ('/v1/sources/add-file', '/v1/sources/add-url'):
+            latency = config.upload_latency
+        elif self.path == '/v1/chats/message':
+            latency = config.chat_latency
+        else:
+            return self.send_json(404, {'error': 'Not found'})
+
+        if config.in_burst():
+            return self.send_json(429, {'error': 'Too many requests'}, {'Retry-After': str(config.retry_after)})
+
+        time.sleep(latency())
+
+        if random.random() < config.error_rate:
+            return self.send_json(500, {'error': 'Injected failure'})
+
+        if self.path != '/v1/chats/message':
+            return self.send_json(200, {'sourceId': config.next_source_id(body)})
+
+        try:
+            data = json.loads(body)
+            question = data['messages'][-1]['content']
+        except (ValueError, KeyError, IndexError, TypeError):
+            return self.send_json(400, {'error': 'Invalid chat request'})
+
+        answer = f"Stub answer for {data.get('sourceId')}: {question}"
+        if data.get('stream'):
+            return self.send_stream(answer)
+        return self.send_json(200, {'content': answer})
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        # Streamed uploads arrive chunked
+        parts = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return b''.join(parts)
+            parts.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def send_json(self, status, payload, headers=None):
+        out = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(out)
+
+    def send_stream(self, answer):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for word in answer.split(' '):
+            chunk = (word + ' ').encode()
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.flush()
+            time.sleep(self.config.token_delay)
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def create_server(host, port, config):
+    handler = type('ConfiguredStubHandler', (StubHandler,), {'config': config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local ChatPDF API stub')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=parse_latency, default=parse_latency('const:0.2'),
+                        help='latency of every endpoint, e.g. const:0.2, uniform:0.1:0.5, lognormal:0.3:0.6')
+    parser.add_argument('--upload-latency', type=parse_latency, help='overrides --latency for add-file/add-url')
+    parser.add_argument('--chat-latency', type=parse_latency, help='overrides --latency for chats/message')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='seconds between streamed words')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--burst-every', type=float, default=0, help='seconds between 429 bursts (0 disables)')
+    parser.add_argument('--burst-length', type=float, default=2, help='seconds each 429 burst lasts')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After sent with 429s')
+    args = parser.parse_args()
+
+    config = StubConfig(
+        upload_latency=args.upload_latency or args.latency,
+        chat_latency=args.chat_latency or args.latency,
+        token_delay=args.token_delay,
+        error_rate=args.error_rate,
+        burst_every=args.burst_every,
+        burst_length=args.burst_length,
+        retry_after=args.retry_after,
+    )
+    server = create_server(args.host, args.port, config)
+    print(f"ChatPDF stub listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import pytest
+
+
+class FakeMemcached:
+    # Just enough of the bmemcached client for the stores: values, cas ids and the expiry
+    # each key was last written with
+
+    def __init__(self):
+        self.values = {}
+        self.expiry = {}
+        self._cas = {}
+        self._next_cas = 0
+
+    def _store(self, key, value, time):
+        self._next_cas += 1
+        self.values[key] = value
+        self.expiry[key] = time
+        self._cas[key] = self._next_cas
+        return True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def gets(self, key):
+        return self.values.get(key), self._cas.get(key)
+
+    def add(self, key, value, time=0):
+        return key not in self.values and self._store(key, value, time)
+
+    def set(self, key, value, time=0):
+        return self._store(key, value, time)
+
+    def cas(self, key, value, cas, time=0):
+        return self._cas.get(key) == cas and self._store(key, value, time)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+        self._cas.pop(key, None)
+        return True
+
+    def incr(self, key, value):
+        if key not in self.values:
+            self.values[key] = 0  # bmemcached's default initial value
+        else:
+            self.values[key] = int(self.values[key]) + value
+        return self.values[key]
+
+
+@pytest.fixture
+def memcached(monkeypatch):
+    import history_store
+    import shared_store
+
+    client = FakeMemcached()
+    monkeypatch.setattr(shared_store, 'get_memcached', lambda: client)
+    monkeypatch.setattr(history_store, 'get_memcached', lambda: client)
+    return client
+
+
+@pytest.fixture
+def sqlite_store(tmp_path):
+    from shared_store import SQLiteStore
+
+    return SQLiteStore(str(tmp_path / 'shared.db'))
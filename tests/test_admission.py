@@ -0,0 +1,78 @@
+from admission import OVERLOADED_PAGE, AdmissionController, AdmissionMiddleware, client_id, queue_delay
+
+
+def test_limit_and_release():
+    controller = AdmissionController(0.05, 10, min_limit=1, max_limit=2, client_share=0)
+    assert controller.admit('a') is None
+    assert controller.admit('b') is None
+    assert controller.admit('c') == 'limit'
+    controller.release('a')
+    assert controller.admit('c') is None
+
+
+def test_client_share():
+    controller = AdmissionController(0.05, 10, min_limit=1, max_limit=4, client_share=0.5)
+    assert controller.admit('a') is None
+    assert controller.admit('a') is None
+    assert controller.admit('a') == 'client'
+    assert controller.admit('b') is None
+
+
+def test_standing_queue_backs_off_and_sheds_late_requests():
+    controller = AdmissionController(0.05, 0, min_limit=2, max_limit=10, backoff=0.5, client_share=0)
+    assert controller.admit('a', delay=0.2) == 'delay'
+    assert controller.overloaded
+    assert controller.limit == 5
+    assert controller.admit('a', delay=0.2) == 'delay'
+    assert controller.limit == 2.5
+
+
+def test_recovers_additively():
+    controller = AdmissionController(0.05, 0, min_limit=2, max_limit=10, backoff=0.5, client_share=0)
+    controller.admit('a', delay=0.2)
+    assert controller.admit('a', delay=0.01) is None
+    assert not controller.overloaded
+    assert controller.limit == 6
+
+
+def test_intervals_without_delays_keep_the_limit():
+    controller = AdmissionController(0.05, 0, min_limit=2, max_limit=10, client_share=0)
+    controller.admit('a')
+    assert controller.limit == 10
+
+
+def test_queue_delay_units():
+    now = 1700000010.0
+    assert queue_delay({'HTTP_X_REQUEST_START': 't=1700000000.0'}, 'X-Request-Start', now) == 10.0
+    assert queue_delay({'HTTP_X_REQUEST_START': '1700000009000'}, 'X-Request-Start', now) == 1.0
+    assert queue_delay({'HTTP_X_REQUEST_START': '1700000009500000'}, 'X-Request-Start', now) == 0.5
+    assert queue_delay({'HTTP_X_REQUEST_START': 'junk'}, 'X-Request-Start', now) is None
+    assert queue_delay({}, 'X-Request-Start', now) is None
+
+
+def test_client_id_uses_nearest_proxy():
+    assert client_id({'HTTP_X_FORWARDED_FOR': 'spoofed, 10.0.0.1', 'REMOTE_ADDR': '127.0.0.1'}) == '10.0.0.1'
+    assert client_id({'REMOTE_ADDR': '127.0.0.1'}) == '127.0.0.1'
+
+
+def test_middleware_sheds_and_releases():
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return [b'ok']
+
+    controller = AdmissionController(0.05, 10, min_limit=1, max_limit=1, client_share=0)
+    rejected = []
+    middleware = AdmissionMiddleware(app, controller, exempt_paths=('/static',), on_reject=rejected.append)
+    statuses = []
+
+    def start_response(status, headers):
+        statuses.append(status)
+
+    response = middleware({'PATH_INFO': '/'}, start_response)
+    assert controller.in_flight == 1
+    assert middleware({'PATH_INFO': '/'}, start_response) == [OVERLOADED_PAGE]
+    assert middleware({'PATH_INFO': '/static/app.css'}, start_response) == [b'ok']
+    response.close()
+    assert controller.in_flight == 0
+    assert statuses == ['200 OK', '503 Service Unavailable', '200 OK']
+    assert rejected == ['limit']
@@ -0,0 +1,57 @@
+import threading
+import time
+
+from bulkhead import Bulkhead
+
+
+def test_try_acquire_up_to_limit():
+    bulkhead = Bulkhead('ingest', limit=2, max_queue=0, timeout=0.1)
+    assert bulkhead.try_acquire()
+    assert bulkhead.try_acquire()
+    assert not bulkhead.try_acquire()
+    bulkhead.release()
+    assert bulkhead.try_acquire()
+
+
+def test_full_queue_sheds_at_once():
+    bulkhead = Bulkhead('chat', limit=1, max_queue=0, timeout=5)
+    bulkhead.acquire()
+    started = time.monotonic()
+    assert not bulkhead.acquire()
+    assert time.monotonic() - started < 1
+
+
+def test_waiter_times_out():
+    bulkhead = Bulkhead('chat', limit=1, max_queue=1, timeout=0.1)
+    bulkhead.acquire()
+    assert not bulkhead.acquire()
+    assert bulkhead.waiting == 0
+    assert bulkhead.active == 1
+
+
+def test_waiter_gets_released_slot():
+    bulkhead = Bulkhead('chat', limit=1, max_queue=1, timeout=5)
+    bulkhead.acquire()
+    threading.Timer(0.1, bulkhead.release).start()
+    assert bulkhead.acquire()
+    assert bulkhead.active == 1
+
+
+def test_background_waits_past_queue_cap():
+    bulkhead = Bulkhead('ingest', limit=1, max_queue=0, timeout=0.01)
+    bulkhead.acquire()
+    threading.Timer(0.1, bulkhead.release).start()
+    assert bulkhead.acquire(background=True)
+
+
+def test_enqueue_respects_max_queue():
+    bulkhead = Bulkhead('chat', limit=1, max_queue=1, timeout=1)
+    assert bulkhead.enqueue()
+    assert not bulkhead.enqueue()
+    bulkhead.dequeue()
+    assert bulkhead.enqueue()
+
+
+def test_retry_after():
+    assert Bulkhead('chat', 1, 1, timeout=0.2).retry_after() == 1
+    assert Bulkhead('chat', 1, 1, timeout=2.5).retry_after() == 3
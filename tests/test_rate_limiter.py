@@ -0,0 +1,53 @@
+import json
+import math
+import time
+
+from rate_limiter import TokenBucket
+
+
+class FailingStore:
+    def update(self, key, fn, ttl):
+        return None
+
+
+def test_burst_then_waits_in_order(sqlite_store):
+    bucket = TokenBucket(sqlite_store, 'chat', per_minute=60, burst=2, max_wait=10)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    first = bucket.reserve()
+    second = bucket.reserve()
+    assert 0.9 < first <= 1.0
+    assert 1.9 < second <= 2.0
+
+
+def test_full_queue_is_refused(sqlite_store):
+    bucket = TokenBucket(sqlite_store, 'chat', per_minute=60, burst=1, max_wait=1.5)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() is not None
+    assert bucket.reserve() is None
+
+
+def test_refused_call_does_not_take_a_token():
+    bucket = TokenBucket(None, 'chat', per_minute=60, burst=1, max_wait=0.5)
+    value, wait = bucket._take(json.dumps({'tokens': 0, 'updated': time.time()}))
+    assert wait == math.inf
+    assert json.loads(value)['tokens'] >= 0
+
+
+def test_buckets_are_shared_by_name(sqlite_store):
+    TokenBucket(sqlite_store, 'chat', per_minute=60, burst=1, max_wait=10).reserve()
+    assert TokenBucket(sqlite_store, 'chat', per_minute=60, burst=1, max_wait=10).reserve() > 0
+    assert TokenBucket(sqlite_store, 'ingest', per_minute=60, burst=1, max_wait=10).reserve() == 0.0
+
+
+def test_store_failure_fails_open():
+    bucket = TokenBucket(FailingStore(), 'chat', per_minute=60, burst=1, max_wait=10)
+    assert bucket.reserve() == 0.0
+
+
+def test_memcached_bucket(memcached):
+    from shared_store import MemcachedStore
+
+    bucket = TokenBucket(MemcachedStore(), 'chat', per_minute=60, burst=1, max_wait=10)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() > 0
@@ -0,0 +1,84 @@
+from resilience import CircuitBreaker, RetryPolicy, retry_after_seconds
+
+
+def open_breaker(open_seconds=0):
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=60, open_seconds=open_seconds)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_at_failure_rate():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4, window=60, open_seconds=30)
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert 0 < breaker.retry_in() <= 30
+
+
+def test_breaker_needs_min_calls():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=3, window=60, open_seconds=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = open_breaker()
+    assert breaker.allow()
+    assert breaker.state == 'half_open'
+    assert not breaker.allow()
+
+
+def test_probe_success_closes():
+    breaker = open_breaker()
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+
+def test_probe_failure_reopens():
+    breaker = open_breaker(open_seconds=30)
+    breaker._opened_at -= 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+
+def test_released_probe_makes_way_for_the_next():
+    # A probe that ends without an outcome (bad request, passed deadline, quota wait) must
+    # not leave the circuit half-open with no probe allowed, forever
+    breaker = open_breaker()
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_release_while_closed_is_harmless():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=60, open_seconds=30)
+    breaker.allow()
+    breaker.release()
+    assert breaker.state == 'closed'
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds('3') == 3.0
+    assert retry_after_seconds('-1') == 0.0
+    assert retry_after_seconds('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert retry_after_seconds('soon') is None
+    assert retry_after_seconds(None) is None
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(retries=2, base_delay=0.5, max_delay=4, max_retry_after=10)
+    assert 0 <= policy.delay(0) <= 0.5
+    assert policy.delay(0, retry_after='5') == 5.0
+    assert policy.delay(0, retry_after='60') is None
+    assert policy.delay(2) is None
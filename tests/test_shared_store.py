@@ -0,0 +1,51 @@
+import time
+
+from history_store import MemcachedHistoryStore
+from shared_store import MEMCACHED_MAX_RELATIVE_TTL, MemcachedStore, memcached_expiry
+
+DAY = 24 * 60 * 60
+
+
+def test_short_ttls_stay_relative():
+    assert memcached_expiry(60) == 60
+    assert memcached_expiry(MEMCACHED_MAX_RELATIVE_TTL) == MEMCACHED_MAX_RELATIVE_TTL
+
+
+def test_long_ttls_become_timestamps():
+    # memcached would read 31 days as a timestamp in January 1970 and expire the key at once
+    expiry = memcached_expiry(31 * DAY)
+    assert abs(expiry - (time.time() + 31 * DAY)) < 5
+
+
+def test_memcached_store_expiry(memcached):
+    store = MemcachedStore()
+    store.set('short', 'v', 60)
+    store.add('long', 'v', 90 * DAY)
+    store.update('bucket', lambda value: ('v', 1), 90 * DAY)
+    assert memcached.expiry['short'] == 60
+    assert memcached.expiry['long'] > time.time()
+    assert memcached.expiry['bucket'] > time.time()
+
+
+def test_memcached_history_expiry(memcached):
+    history = MemcachedHistoryStore(max_messages=2, max_conversations=10, ttl=90 * DAY)
+    history.create('src')
+    assert memcached.expiry['history:src'] > time.time()
+    history.append('src', [{'role': 'user', 'content': 'hi'}])
+    assert memcached.expiry['history:src'] > time.time()
+
+
+def test_memcached_history_trims_messages(memcached):
+    history = MemcachedHistoryStore(max_messages=2, max_conversations=10, ttl=60)
+    history.create('src')
+    for i in range(3):
+        history.append('src', [{'content': str(i)}])
+    assert [message['content'] for message in history.get('src')] == ['1', '2']
+
+
+def test_memcached_history_conversation_cap(memcached):
+    history = MemcachedHistoryStore(max_messages=10, max_conversations=3, ttl=60)
+    for i in range(5):
+        history.create(f'src{i}')
+    conversations = sorted(key for key in memcached.values if key.startswith('history:'))
+    assert conversations == ['history:src2', 'history:src3', 'history:src4']
@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import AsyncSingleFlight, SingleFlight
+
+
+def run_concurrently(count, fn):
+    results = [None] * count
+    barrier = threading.Barrier(count)
+
+    def worker(i):
+        barrier.wait()
+        try:
+            results[i] = fn()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_calls_share_one_run():
+    flight = SingleFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'answer', None
+
+    results = run_concurrently(5, lambda: flight.do(('chat', 'src', 'q'), slow))
+    assert results == [('answer', None)] * 5
+    assert len(calls) == 1
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight()
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.do('b', lambda: 2) == 2
+
+
+def test_later_calls_run_again():
+    flight = SingleFlight()
+    calls = []
+    flight.do('a', calls.append, 1)
+    flight.do('a', calls.append, 2)
+    assert calls == [1, 2]
+
+
+def test_error_reaches_waiters():
+    flight = SingleFlight()
+
+    def failing():
+        time.sleep(0.2)
+        raise RuntimeError('upstream down')
+
+    results = run_concurrently(3, lambda: flight.do('a', failing))
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flight._calls == {}
+
+
+def test_waiter_gives_up_when_time_is_up():
+    class TimeUp(Exception):
+        pass
+
+    def time_left():
+        raise TimeUp()
+
+    flight = SingleFlight(time_left=time_left)
+    started = threading.Event()
+
+    def leader():
+        started.set()
+        time.sleep(0.3)
+        return 'late'
+
+    thread = threading.Thread(target=flight.do, args=('a', leader))
+    thread.start()
+    started.wait()
+    with pytest.raises(TimeUp):
+        flight.do('a', lambda: 'unused')
+    thread.join()
+
+
+def test_shared_flight_across_stores(sqlite_store):
+    # Two flights on one store stand in for two workers
+    first = SingleFlight(sqlite_store, poll_interval=0.01)
+    second = SingleFlight(sqlite_store, poll_interval=0.01)
+    calls = []
+    started = threading.Event()
+
+    def slow():
+        calls.append(1)
+        started.set()
+        time.sleep(0.2)
+        return ['answer', 'src']
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(first.do('k', slow)))
+    thread.start()
+    started.wait()
+    assert second.do('k', slow) == ('answer', 'src')
+    thread.join()
+    assert results == [['answer', 'src']]
+    assert len(calls) == 1
+
+
+def test_coalesce_decorator():
+    flight = SingleFlight()
+
+    @flight.coalesce(lambda source_id, message: ('chat', source_id, message.lower()))
+    def ask(source_id, message):
+        return source_id, message
+
+    assert ask('src', 'Hi') == ('src', 'Hi')
+    assert ask.__name__ == 'ask'
+
+
+def test_async_concurrent_calls_share_one_task():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def slow(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return value, None
+
+    async def main():
+        return await asyncio.gather(*(flight.do('a', slow, i) for i in range(5)))
+
+    assert asyncio.run(main()) == [(0, None)] * 5
+    assert calls == [0]
+    assert flight._calls == {}
+
+
+def test_async_cancelled_caller_leaves_the_task_to_the_others():
+    flight = AsyncSingleFlight()
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return 'answer'
+
+    async def main():
+        first = asyncio.ensure_future(flight.do('a', slow))
+        second = asyncio.ensure_future(flight.do('a', slow))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == 'answer'
+
+
+def test_async_waiter_gives_up_when_time_is_up():
+    class TimeUp(Exception):
+        pass
+
+    left = iter([0.01])
+
+    def time_left():
+        try:
+            return next(left)
+        except StopIteration:
+            raise TimeUp()
+
+    flight = AsyncSingleFlight(time_left=time_left)
+
+    async def main():
+        await flight.do('a', asyncio.sleep, 0.2)
+
+    with pytest.raises(TimeUp):
+        asyncio.run(main())
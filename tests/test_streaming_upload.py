@@ -0,0 +1,65 @@
+import io
+
+import pytest
+
+from streaming_upload import FieldTooLarge, MultipartReader, multipart_file_body
+
+BOUNDARY = 'test-boundary'
+
+
+def form_body(*parts):
+    body = b''
+    for name, filename, data in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += f'--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n'.encode() + data + b'\r\n'
+    return body + f'--{BOUNDARY}--\r\n'.encode()
+
+
+def reader(body, chunk_size=7):
+    return MultipartReader(io.BytesIO(body), BOUNDARY, chunk_size=chunk_size)
+
+
+def test_reads_fields_and_streams_files():
+    pdf = b'%PDF-1.4 ' + bytes(range(256)) * 40
+    multipart = reader(form_body(('token', None, b'abc'), ('file', 'doc.pdf', pdf)))
+    parts = multipart.parts()
+
+    assert next(parts) == ('token', None)
+    assert multipart.read_field() == 'abc'
+    assert next(parts) == ('file', 'doc.pdf')
+    assert b''.join(multipart.iter_data()) == pdf
+    assert list(parts) == []
+
+
+def test_unread_parts_are_skipped():
+    multipart = reader(form_body(('file', 'a.pdf', b'x' * 1000), ('token', None, b'abc')))
+    names = []
+    for name, _ in multipart.parts():
+        names.append(name)
+        if name == 'token':
+            assert multipart.read_field() == 'abc'
+    assert names == ['file', 'token']
+
+
+def test_field_too_large():
+    multipart = reader(form_body(('token', None, b'x' * 2000)))
+    next(multipart.parts())
+    with pytest.raises(FieldTooLarge):
+        multipart.read_field(limit=1024)
+
+
+def test_field_at_limit_is_read():
+    multipart = reader(form_body(('token', None, b'x' * 1024)))
+    next(multipart.parts())
+    assert multipart.read_field(limit=1024) == 'x' * 1024
+
+
+def test_file_body_round_trip():
+    chunks = [b'%PDF', b'-1.4', b' body']
+    body, content_type = multipart_file_body(iter(chunks), filename='doc.pdf', content_type='application/pdf')
+    boundary = content_type.split('boundary=')[1]
+    multipart = MultipartReader(io.BytesIO(b''.join(body)), boundary)
+    assert next(multipart.parts()) == ('file', 'doc.pdf')
+    assert b''.join(multipart.iter_data()) == b''.join(chunks)
@@ -0,0 +1,105 @@
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+
+class ApiKey:
+    def __init__(self, key):
+        self.key = key
+        # Safe to log and to use in store keys and metric labels
+        self.id = hashlib.sha256(key.encode()).hexdigest()[:12]
+        self.in_flight = 0
+        self.ejected_until = 0.0
+        self.last_used = 0
+
+
+class KeyPool:
+    # ChatPDF API keys of this worker. New work goes to the healthy key with the fewest calls
+    # in flight; keys answering 401 or 429 are ejected for a while. A sourceId only exists
+    # under the key that created it, so that binding is kept durably in `bindings` (with
+    # get_key/put_key, e.g. the SourceIndex) and chat calls always use the bound key. Sources
+    # without a binding use the first key. Bindings never change, so recently used ones are
+    # also remembered in this process.
+
+    def __init__(self, keys, bindings, eject_seconds, cached_bindings=10000):
+        self.keys = [ApiKey(key) for key in keys]
+        self.bindings = bindings
+        self.eject_seconds = eject_seconds
+        self._by_id = {key.id: key for key in self.keys}
+        self._uses = itertools.count(1)
+        self._lock = threading.Lock()
+        self._bindings = OrderedDict()
+        self._cached_bindings = cached_bindings
+
+    def _remember(self, source_id, key):
+        with self._lock:
+            self._bindings[source_id] = key
+            self._bindings.move_to_end(source_id)
+            if len(self._bindings) > self._cached_bindings:
+                self._bindings.popitem(last=False)
+
+    def healthy(self):
+        now = time.monotonic()
+        return [key for key in self.keys if key.ejected_until <= now]
+
+    def choose(self, source_id=None):
+        if len(self.keys) == 1:
+            return self.keys[0]
+
+        if source_id is not None:
+            with self._lock:
+                key = self._bindings.get(source_id)
+            if key is None:
+                key = self._by_id.get(self.bindings.get_key(source_id))
+                if key is None:
+                    return self.keys[0]  # A guess, so it is not remembered
+                self._remember(source_id, key)
+            return key
+
+        with self._lock:
+            # With every key ejected, use the one that comes back first
+            candidates = self.healthy() or [min(self.keys, key=lambda key: key.ejected_until)]
+            # Ties go to the least recently used key, so idle keys take turns
+            key = min(candidates, key=lambda key: (key.in_flight, key.last_used))
+            key.last_used = next(self._uses)
+            return key
+
+    def bind(self, source_id, key):
+        if len(self.keys) == 1:
+            return
+        self.bindings.put_key(source_id, key.id)
+        self._remember(source_id, key)
+
+    def eject(self, key, seconds=None):
+        key.ejected_until = time.monotonic() + (seconds if seconds is not None else self.eject_seconds)
+
+    def acquire(self, key):
+        with self._lock:
+            key.in_flight += 1
+
+    def release(self, key):
+        with self._lock:
+            key.in_flight -= 1
+
+
+class BaseUrls:
+    # The primary ChatPDF base URL and optional fallbacks. A URL that cannot be connected
+    # to is skipped for eject_seconds; with all of them down the primary is tried anyway.
+
+    def __init__(self, urls, eject_seconds):
+        self.urls = urls
+        self.eject_seconds = eject_seconds
+        self._down_until = {}
+
+    def choose(self):
+        now = time.monotonic()
+        for url in self.urls:
+            if self._down_until.get(url, 0.0) <= now:
+                return url
+        return self.urls[0]
+
+    def eject(self, url):
+        if len(self.urls) > 1:
+            self._down_until[url] = time.monotonic() + self.eject_seconds